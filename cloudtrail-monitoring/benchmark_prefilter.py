@@ -0,0 +1,149 @@
+"""Compares decoding every CloudTrail record against the raw-bytes prefilter.
+
+Generates a synthetic digest of decompressed CloudTrail log files and
+reports the records/sec of both approaches, e.g.:
+
+    python benchmark_prefilter.py --size-mb 100 \
+        --config cloudtrail_monitoring_config.json
+
+The files are kept decompressed, since decompressing them costs the same with
+either approach and would only hide the difference in parsing.
+"""
+import json
+import time
+import random
+import argparse
+
+from cloudtrail_rules import RuleSet, parse_records
+
+EVENTS = [
+    ('s3.amazonaws.com', 'GetObject'),
+    ('s3.amazonaws.com', 'PutObject'),
+    ('s3.amazonaws.com', 'ListObjects'),
+    ('ec2.amazonaws.com', 'DescribeInstances'),
+    ('ec2.amazonaws.com', 'DescribeSecurityGroups'),
+    ('iam.amazonaws.com', 'GetRole'),
+    ('sts.amazonaws.com', 'AssumeRole'),
+    ('kms.amazonaws.com', 'Decrypt'),
+    ('logs.amazonaws.com', 'PutLogEvents'),
+    ('cloudwatch.amazonaws.com', 'GetMetricData'),
+]
+MATCHING_EVENTS = [
+    ('s3.amazonaws.com', 'CreateBucket'),
+    ('ec2.amazonaws.com', 'AuthorizeSecurityGroupIngress'),
+]
+RECORDS_PER_FILE = 1000
+
+
+def generate_record(i, source, event_name):
+    """
+    :param i: a running index, used for unique IDs.
+    :param source: the record's eventSource.
+    :param event_name: the record's eventName.
+    :return: a synthetic CloudTrail record.
+    """
+    account = str(100000000000 + i % 7)
+    return {
+        'eventVersion': '1.05',
+        'userIdentity': {
+            'type': 'AssumedRole',
+            'principalId': 'AROAEXAMPLE:session{0}'.format(i % 50),
+            'arn': 'arn:aws:sts::{0}:assumed-role/role/session{1}'.format(
+                account, i % 50),
+            'accountId': account,
+            'sessionContext': {
+                'attributes': {'mfaAuthenticated': 'false',
+                               'creationDate': '2018-01-01T00:00:00Z'}}
+        },
+        'eventTime': '2018-01-01T00:00:{0:02d}Z'.format(i % 60),
+        'eventSource': source,
+        'eventName': event_name,
+        'awsRegion': 'eu-west-1',
+        'sourceIPAddress': '10.0.{0}.{1}'.format(i % 256, i % 199),
+        'userAgent': 'aws-sdk-java/1.11.0 Linux/4.9 OpenJDK_64-Bit',
+        'requestParameters': {
+            'bucketName': 'bucket-{0}'.format(i),
+            'groupId': 'sg-{0:08x}'.format(i),
+            'ipPermissions': {'items': [{'ipRanges': {'items': [
+                {'cidrIp': '0.0.0.0/0'}]}}]}
+        },
+        'responseElements': None,
+        'requestID': '{0:032x}'.format(i),
+        'eventID': '{0:032x}'.format(i * 7919),
+        'eventType': 'AwsApiCall',
+        'recipientAccountId': account
+    }
+
+
+def generate_digest(size_mb, match_rate, seed=0):
+    """Generates decompressed CloudTrail log files.
+
+    :param size_mb: the total size of the log files.
+    :param match_rate: the fraction of records with a matching event.
+    :param seed: random seed.
+    :return: a list of log files' bytes, and the number of records.
+    """
+    rand = random.Random(seed)
+    files = []
+    total_size = 0
+    i = 0
+    while total_size < size_mb * 1024 * 1024:
+        records = []
+        for _ in range(RECORDS_PER_FILE):
+            if rand.random() < match_rate:
+                source, event_name = rand.choice(MATCHING_EVENTS)
+            else:
+                source, event_name = rand.choice(EVENTS)
+            records.append(generate_record(i, source, event_name))
+            i += 1
+        raw = json.dumps({'Records': records},
+                         separators=(',', ':')).encode('utf-8')
+        files.append(raw)
+        total_size += len(raw)
+    return files, i
+
+
+def run(files, rule_set, use_prefilter):
+    """
+    :param files: decompressed log files.
+    :param rule_set: the rules to match.
+    :param use_prefilter: whether to prefilter the raw bytes.
+    :return: the elapsed time and the number of matched records.
+    """
+    matched = 0
+    start = time.time()
+    for raw in files:
+        records = parse_records(raw, rule_set if use_prefilter else None)
+        for record in records:
+            if rule_set.match(record):
+                matched += 1
+    return time.time() - start, matched
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size-mb', type=float, default=100)
+    parser.add_argument('--match-rate', type=float, default=0.005)
+    parser.add_argument('--config',
+                        default='cloudtrail_monitoring_config.json')
+    args = parser.parse_args()
+
+    with open(args.config, 'r') as f:
+        rule_set = RuleSet.from_config(json.load(f))
+    files, record_count = generate_digest(args.size_mb, args.match_rate)
+    print('Generated {0} records in {1} files ({2:.1f} MB)'.format(
+        record_count, len(files), sum(len(f) for f in files) / 1048576.0))
+
+    results = {}
+    for name, use_prefilter in (('full decode', False),
+                                ('prefilter', True)):
+        elapsed, matched = run(files, rule_set, use_prefilter)
+        results[name] = record_count / elapsed
+        print('{0:>12}: {1:.2f}s, {2:.0f} records/sec, {3} matches'.format(
+            name, elapsed, results[name], matched))
+    print('Speedup: {0:.1f}x'.format(
+        results['prefilter'] / results['full decode']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,219 @@
+"""A partitioned archive of matched CloudTrail records.
+
+Records are appended as compressed JSON lines part files under
+account=<account>/date=<YYYY-MM-DD>/ partitions. Each part file has a small
+index of the line numbers of every eventName and principal in it, so a search
+only decompresses the part files that contain what it looks for, e.g.:
+
+    python cloudtrail_archive.py --root ./archive \
+        --principal arn:aws:iam::111111111111:user/someone --start 2018-01-01
+
+Part files are zstd compressed when the zstandard package is installed,
+otherwise gzipped; reading .zst parts requires zstandard too. An archive
+uploaded to S3 can be searched after syncing it to a local directory.
+"""
+import io
+import os
+import gzip
+import json
+import time
+import uuid
+import logging
+import argparse
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger()
+
+INDEX_SUFFIX = '.idx.json'
+
+
+def get_principal(record):
+    """
+    :param record: a CloudTrail record.
+    :return: the ARN of the caller, or its principal ID if it has no ARN.
+    """
+    user_identity = record.get('userIdentity') or {}
+    return user_identity.get('arn') or user_identity.get('principalId')
+
+
+def get_partition(record):
+    """
+    :param record: a CloudTrail record.
+    :return: the relative path of the record's partition.
+    """
+    return 'account={0}/date={1}'.format(
+        record.get('recipientAccountId', 'unknown'),
+        record.get('eventTime', 'unknown')[:10])
+
+
+def compress(data):
+    """
+    :param data: bytes to compress.
+    :return: the compressed bytes and the part file's extension.
+    """
+    if zstandard is not None:
+        return zstandard.ZstdCompressor().compress(data), '.jsonl.zst'
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb') as gz_file:
+        gz_file.write(data)
+    return buf.getvalue(), '.jsonl.gz'
+
+
+def read_part(path):
+    """
+    :param path: a part file's path.
+    :return: the decompressed lines of the part file.
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    if path.endswith('.zst'):
+        data = zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    else:
+        data = gzip.GzipFile(fileobj=io.BytesIO(data)).read()
+    return data.decode('utf-8').splitlines()
+
+
+class Archive(object):
+    """Appends records to, and searches, a local partitioned archive. The
+    appended part files can also be uploaded to S3 under the same layout.
+    """
+
+    def __init__(self, root, s3_client=None, s3_bucket=None, s3_prefix=''):
+        """
+        :param root: the archive's local directory, may be None if it's
+            only uploaded.
+        :param s3_client: if given, part files are uploaded to s3_bucket
+            instead of being written to the local directory.
+        :param s3_bucket: the bucket to upload to.
+        :param s3_prefix: a key prefix to upload under.
+        """
+        self.root = root
+        self.s3_client = s3_client
+        self.s3_bucket = s3_bucket
+        self.s3_prefix = s3_prefix
+
+    def append(self, records):
+        """Appends the records, as a new part file in each of their
+        partitions.
+
+        :param records: a list of CloudTrail records.
+        :return: the relative paths of the written part files.
+        """
+        partitions = {}
+        for record in records:
+            partitions.setdefault(get_partition(record), []).append(record)
+
+        paths = []
+        part_name = 'part-{0}-{1}'.format(int(time.time()),
+                                          uuid.uuid4().hex[:8])
+        for partition, partition_records in sorted(partitions.items()):
+            index = {'eventName': {}, 'principal': {}}
+            lines = []
+            for i, record in enumerate(partition_records):
+                lines.append(json.dumps(record))
+                index['eventName'].setdefault(
+                    record.get('eventName'), []).append(i)
+                index['principal'].setdefault(
+                    get_principal(record), []).append(i)
+            data, extension = compress(
+                ('\n'.join(lines) + '\n').encode('utf-8'))
+            part_path = partition + '/' + part_name + extension
+            self._write(part_path, data)
+            self._write(part_path + INDEX_SUFFIX,
+                        json.dumps(index).encode('utf-8'))
+            paths.append(part_path)
+        return paths
+
+    def _write(self, relative_path, data):
+        if self.s3_client is not None:
+            self.s3_client.put_object(Bucket=self.s3_bucket,
+                                      Key=self.s3_prefix + relative_path,
+                                      Body=data)
+            return
+        path = os.path.join(self.root, *relative_path.split('/'))
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(path, 'wb') as f:
+            f.write(data)
+
+    def get_partitions(self, account=None, start=None, end=None):
+        """
+        :param account: only the partitions of this account.
+        :param start: only the partitions from this date (YYYY-MM-DD).
+        :param end: only the partitions until this date (YYYY-MM-DD).
+        :return: the paths of the matching partitions.
+        """
+        partitions = []
+        if not os.path.isdir(self.root):
+            return partitions
+        for account_dir in sorted(os.listdir(self.root)):
+            if account and account_dir != 'account=' + account:
+                continue
+            account_path = os.path.join(self.root, account_dir)
+            for date_dir in sorted(os.listdir(account_path)):
+                date = date_dir[len('date='):]
+                if (start and date < start) or (end and date > end):
+                    continue
+                partitions.append(os.path.join(account_path, date_dir))
+        return partitions
+
+    def search(self, principal=None, event_name=None, account=None,
+               start=None, end=None):
+        """Yields the archived records that match all of the given criteria.
+        Only part files whose index has the principal and event name are
+        decompressed.
+
+        :param principal: the caller's ARN (or principal ID).
+        :param event_name: the eventName.
+        :param account: the account number.
+        :param start: the first date (YYYY-MM-DD).
+        :param end: the last date (YYYY-MM-DD).
+        """
+        for partition in self.get_partitions(account, start, end):
+            for file_name in sorted(os.listdir(partition)):
+                if not file_name.endswith(INDEX_SUFFIX):
+                    continue
+                index_path = os.path.join(partition, file_name)
+                with open(index_path, 'r') as f:
+                    index = json.load(f)
+                lines = None
+                for field, value in (('principal', principal),
+                                     ('eventName', event_name)):
+                    if value is None:
+                        continue
+                    field_lines = set(index[field].get(value, []))
+                    lines = field_lines if lines is None \
+                        else lines & field_lines
+                if lines is not None and not lines:
+                    continue
+                part_lines = read_part(index_path[:-len(INDEX_SUFFIX)])
+                for i in sorted(lines) if lines is not None \
+                        else range(len(part_lines)):
+                    yield json.loads(part_lines[i])
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Searches the archive of matched CloudTrail records.')
+    parser.add_argument('--root', required=True,
+                        help="the archive's directory")
+    parser.add_argument('--principal', help="the caller's ARN")
+    parser.add_argument('--event-name')
+    parser.add_argument('--account')
+    parser.add_argument('--start', help='the first date (YYYY-MM-DD)')
+    parser.add_argument('--end', help='the last date (YYYY-MM-DD)')
+    args = parser.parse_args()
+
+    archive = Archive(args.root)
+    for record in archive.search(args.principal, args.event_name,
+                                 args.account, args.start, args.end):
+        print(json.dumps(record))
+
+
+if __name__ == '__main__':
+    main()
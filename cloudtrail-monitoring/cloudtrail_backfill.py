@@ -0,0 +1,314 @@
+"""Runs the cloudtrail_monitoring rules over historical CloudTrail logs.
+
+Lists the trail's AWSLogs/<account>/CloudTrail/<region>/YYYY/MM/DD/ prefixes
+in parallel, scans their log files through a worker pool and writes the
+matched records as JSON lines. Progress is checkpointed per prefix, so an
+interrupted backfill resumes where it stopped, e.g.:
+
+    python cloudtrail_backfill.py --bucket my-trail-bucket --days 90 \
+        --config cloudtrail_monitoring_config.json --output matches.jsonl \
+        --checkpoint backfill_checkpoint.json
+
+Use --local-dir to scan a local directory of buckets instead of S3.
+"""
+import os
+import sys
+import json
+import logging
+import argparse
+from datetime import datetime, timedelta
+from multiprocessing.dummy import Pool as ThreadPool
+
+from cloudtrail_rules import RuleSet, decompress_stream, parse_records
+
+logger = logging.getLogger()
+
+LOGS_PREFIX = 'AWSLogs/'
+
+
+class Checkpoint(object):
+    """Remembers the prefixes that were fully scanned in a local JSON file.
+    """
+
+    def __init__(self, path=None):
+        """
+        :param path: the checkpoint file, if None nothing is persisted.
+        """
+        self.path = path
+        self.done = set()
+        if path and os.path.exists(path):
+            with open(path, 'r') as f:
+                self.done = set(json.load(f)['done'])
+
+    def mark_done(self, prefix):
+        """Marks the prefix as scanned and persists the checkpoint.
+
+        :param prefix: the scanned prefix.
+        """
+        self.done.add(prefix)
+        if not self.path:
+            return
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'done': sorted(self.done)}, f)
+        os.rename(tmp_path, self.path)
+
+
+def list_common_prefixes(s3_client, bucket, prefix):
+    """
+    :param s3_client: S3 client to use.
+    :param bucket: the trail's bucket.
+    :param prefix: the prefix to list under.
+    :return: the names of the "directories" directly under the prefix.
+    """
+    names = []
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix,
+                                   Delimiter='/'):
+        for common_prefix in page.get('CommonPrefixes', []):
+            names.append(common_prefix['Prefix'][len(prefix):].rstrip('/'))
+    return names
+
+
+def list_keys(s3_client, bucket, prefix):
+    """
+    :param s3_client: S3 client to use.
+    :param bucket: the trail's bucket.
+    :param prefix: the prefix to list under.
+    :return: the keys of the log files under the prefix.
+    """
+    keys = []
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            if obj['Key'].endswith('.json.gz'):
+                keys.append(obj['Key'])
+    return keys
+
+
+def get_day_prefixes(s3_client, bucket, start, end, trail_prefix='',
+                     accounts=None, regions=None):
+    """Returns the daily prefixes of the trail's log files, from the newest
+    day to the oldest. Accounts and regions that aren't given are discovered
+    by listing the bucket.
+
+    :param s3_client: S3 client to use.
+    :param bucket: the trail's bucket.
+    :param start: the first day (date).
+    :param end: the last day (date).
+    :param trail_prefix: the trail's S3 key prefix, if any.
+    :param accounts: account numbers to scan.
+    :param regions: regions to scan.
+    :return: a list of prefixes.
+    """
+    logs_prefix = trail_prefix.rstrip('/') + '/' + LOGS_PREFIX \
+        if trail_prefix else LOGS_PREFIX
+    if not accounts:
+        accounts = list_common_prefixes(s3_client, bucket, logs_prefix)
+    account_prefixes = [
+        '{0}{1}/CloudTrail/'.format(logs_prefix, account)
+        for account in accounts]
+    if regions:
+        region_prefixes = [account_prefix + region + '/'
+                           for account_prefix in account_prefixes
+                           for region in regions]
+    else:
+        pool = ThreadPool(min(len(account_prefixes), 16) or 1)
+        try:
+            account_regions = pool.map(
+                lambda account_prefix: list_common_prefixes(
+                    s3_client, bucket, account_prefix),
+                account_prefixes)
+        finally:
+            pool.close()
+            pool.join()
+        region_prefixes = [account_prefix + region + '/'
+                           for account_prefix, found_regions
+                           in zip(account_prefixes, account_regions)
+                           for region in found_regions]
+
+    prefixes = []
+    day = end
+    while day >= start:
+        for region_prefix in region_prefixes:
+            prefixes.append(region_prefix + day.strftime('%Y/%m/%d/'))
+        day -= timedelta(days=1)
+    return prefixes
+
+
+def scan_object(s3_client, bucket, key, rule_set):
+    """
+    :param s3_client: S3 client to use.
+    :param bucket: the trail's bucket.
+    :param key: the log file's key.
+    :param rule_set: the rules to match.
+    :return: a list of (matched rule names, record) tuples.
+    """
+    body = s3_client.get_object(Bucket=bucket, Key=key)['Body']
+    matches = []
+    for record in parse_records(decompress_stream(body), rule_set):
+        rules = rule_set.match(record)
+        if rules:
+            matches.append(([rule.name for rule in rules], record))
+    return matches
+
+
+def backfill(s3_client, bucket, prefixes, rule_set, output, checkpoint,
+             workers=16):
+    """Scans the log files under the prefixes and writes the matches. The
+    prefixes are listed in the background while the log files of the listed
+    ones are scanned.
+
+    :param s3_client: S3 client to use.
+    :param bucket: the trail's bucket.
+    :param prefixes: the prefixes to scan.
+    :param rule_set: the rules to match.
+    :param output: a file to write the matches to, as JSON lines.
+    :param checkpoint: a Checkpoint of the prefixes that were already scanned.
+    :param workers: the number of concurrent listings and downloads.
+    :return: a dict of statistics.
+    """
+    pending = [prefix for prefix in prefixes if prefix not in checkpoint.done]
+    stats = {'prefixes': 0, 'skipped_prefixes': len(prefixes) - len(pending),
+             'failed_prefixes': 0, 'objects': 0, 'failed_objects': 0,
+             'matches': 0}
+    if not pending:
+        return stats
+
+    def list_prefix(prefix):
+        try:
+            return prefix, list_keys(s3_client, bucket, prefix)
+        except Exception:
+            logger.exception('Failed listing s3://{0}/{1}'.format(bucket,
+                                                                  prefix))
+            return prefix, None
+
+    def scan(key):
+        try:
+            return key, scan_object(s3_client, bucket, key, rule_set)
+        except Exception:
+            logger.exception('Failed scanning s3://{0}/{1}'.format(bucket,
+                                                                   key))
+            return key, None
+
+    list_pool = ThreadPool(min(workers, len(pending)))
+    scan_pool = ThreadPool(workers)
+    try:
+        for prefix, keys in list_pool.imap_unordered(list_prefix, pending):
+            if keys is None:
+                # Not checkpointed, so it's listed again when resuming
+                stats['failed_prefixes'] += 1
+                continue
+            prefix_matches = []
+            failed = False
+            for key, matches in scan_pool.imap_unordered(scan, keys):
+                stats['objects'] += 1
+                if matches is None:
+                    failed = True
+                    stats['failed_objects'] += 1
+                else:
+                    prefix_matches.extend(matches)
+            stats['prefixes'] += 1
+            if failed:
+                # The prefix is scanned again when resuming, so its matches
+                # are written only once all of its objects are scanned
+                logger.warning('Not writing or checkpointing {0}, some of '
+                               'its objects failed'.format(prefix))
+                continue
+            for rule_names, record in prefix_matches:
+                output.write(json.dumps({'rules': rule_names,
+                                         'record': record}) + '\n')
+            output.flush()
+            stats['matches'] += len(prefix_matches)
+            checkpoint.mark_done(prefix)
+            logger.info('Scanned {0}: {1} objects, {2} matches'.format(
+                prefix, len(keys), len(prefix_matches)))
+    finally:
+        list_pool.close()
+        scan_pool.close()
+        list_pool.join()
+        scan_pool.join()
+    return stats
+
+
+def get_s3_client(args):
+    """
+    :param args: the parsed command line arguments.
+    :return: the S3 client to scan with.
+    """
+    if args.local_dir:
+        from cloudtrail_local import LocalS3Client
+        return LocalS3Client(args.local_dir)
+    import boto3
+    import botocore.client
+    session = boto3.session.Session(profile_name=args.profile)
+    return session.client(
+        's3',
+        endpoint_url=args.endpoint_url,
+        config=botocore.client.Config(
+            max_pool_connections=args.workers * 2))
+
+
+def parse_date(value):
+    return datetime.strptime(value, '%Y-%m-%d').date()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Runs the cloudtrail_monitoring rules over historical '
+                    'CloudTrail logs.')
+    parser.add_argument('--bucket', required=True,
+                        help="the trail's bucket")
+    parser.add_argument('--config', required=True,
+                        help='the cloudtrail_monitoring rules config')
+    parser.add_argument('--trail-prefix', default='',
+                        help="the trail's S3 key prefix")
+    parser.add_argument('--accounts', nargs='*',
+                        help='accounts to scan, discovered if not given')
+    parser.add_argument('--regions', nargs='*',
+                        help='regions to scan, discovered if not given')
+    parser.add_argument('--days', type=int, default=90,
+                        help='how many days back to scan')
+    parser.add_argument('--start', type=parse_date,
+                        help='the first day to scan (YYYY-MM-DD), overrides '
+                             '--days')
+    parser.add_argument('--end', type=parse_date,
+                        help='the last day to scan (YYYY-MM-DD), today if '
+                             'not given')
+    parser.add_argument('--workers', type=int, default=16)
+    parser.add_argument('--checkpoint',
+                        help='a checkpoint file to resume from')
+    parser.add_argument('--output', help='matches output, stdout if not '
+                                         'given')
+    parser.add_argument('--profile', help='AWS profile to use')
+    parser.add_argument('--endpoint-url', help='S3 endpoint URL')
+    parser.add_argument('--local-dir',
+                        help='scan a local directory of buckets instead of '
+                             'S3')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    with open(args.config, 'r') as f:
+        rule_set = RuleSet.from_config(json.load(f))
+    end = args.end or datetime.utcnow().date()
+    start = args.start or end - timedelta(days=args.days - 1)
+    s3_client = get_s3_client(args)
+    prefixes = get_day_prefixes(s3_client, args.bucket, start, end,
+                                args.trail_prefix, args.accounts,
+                                args.regions)
+    checkpoint = Checkpoint(args.checkpoint)
+    logger.info('Scanning {0} prefixes, {1} were already scanned'.format(
+        len(prefixes), len(checkpoint.done.intersection(prefixes))))
+
+    output = open(args.output, 'a') if args.output else sys.stdout
+    try:
+        stats = backfill(s3_client, args.bucket, prefixes, rule_set, output,
+                         checkpoint, args.workers)
+    finally:
+        if args.output:
+            output.close()
+    logger.info('Done: {0}'.format(stats))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,187 @@
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger()
+
+
+class LRUCache(object):
+    """A bounded, thread-safe set of keys that evicts the least recently used
+    key when it's full.
+    """
+
+    def __init__(self, max_size):
+        """
+        :param max_size: the maximal number of keys to keep.
+        """
+        self.max_size = max_size
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self._lock:
+            if key not in self._keys:
+                return False
+            # Mark it as recently used
+            self._keys[key] = self._keys.pop(key)
+            return True
+
+    def __len__(self):
+        return len(self._keys)
+
+    def add(self, key):
+        """Adds the key.
+
+        :param key: a hashable key.
+        :return: whether the key was not in the cache already.
+        """
+        with self._lock:
+            if key in self._keys:
+                self._keys[key] = self._keys.pop(key)
+                return False
+            self._keys[key] = True
+            while len(self._keys) > self.max_size:
+                self._keys.popitem(last=False)
+            return True
+
+    def discard(self, key):
+        """Removes the key if it's in the cache.
+
+        :param key: a hashable key.
+        """
+        with self._lock:
+            self._keys.pop(key, None)
+
+
+class DedupStore(object):
+    """A persistent store of the keys that are being or were already
+    processed, shared by all the containers.
+    """
+
+    def claim(self, key):
+        """Atomically marks the key as being processed. The claim is a lease
+        that expires if the key isn't completed, e.g. when the invocation
+        that claimed it timed out.
+
+        :param key: a string key.
+        :return: whether the key was not marked already, or its lease
+            expired.
+        """
+        raise NotImplementedError()
+
+    def complete(self, key):
+        """Marks a claimed key as processed.
+
+        :param key: a string key.
+        """
+        raise NotImplementedError()
+
+    def release(self, key):
+        """Unmarks the key, so it'll be processed again.
+
+        :param key: a string key.
+        """
+        raise NotImplementedError()
+
+
+class DynamoDBDedupStore(DedupStore):
+    """Keeps the keys in a DynamoDB table whose hash key is a string 'id'
+    attribute. A claimed key's 'expires_at' attribute is the end of its lease,
+    and a completed key's is the end of its TTL. The table's TTL deletes
+    expired items eventually, until then they can be claimed again.
+    """
+
+    def __init__(self, client, table_name, ttl, lease):
+        """
+        :param client: a boto3 DynamoDB client.
+        :param table_name: the table name.
+        :param ttl: how long to keep the completed keys (seconds).
+        :param lease: how long a claim lasts before it's completed
+            (seconds).
+        """
+        self.client = client
+        self.table_name = table_name
+        self.ttl = ttl
+        self.lease = lease
+
+    def _put(self, key, status, expires_at, **kwargs):
+        self.client.put_item(
+            TableName=self.table_name,
+            Item={'id': {'S': key},
+                  'status': {'S': status},
+                  'expires_at': {'N': str(int(expires_at))}},
+            **kwargs)
+
+    def claim(self, key):
+        now = time.time()
+        try:
+            self._put(key, 'in_progress', now + self.lease,
+                      ConditionExpression='attribute_not_exists(id) OR '
+                                          'expires_at < :now',
+                      ExpressionAttributeValues={
+                          ':now': {'N': str(int(now))}})
+        except self.client.exceptions.ConditionalCheckFailedException:
+            return False
+        return True
+
+    def complete(self, key):
+        self._put(key, 'done', time.time() + self.ttl)
+
+    def release(self, key):
+        self.client.delete_item(TableName=self.table_name,
+                                Key={'id': {'S': key}})
+
+
+class Deduplicator(object):
+    """Skips keys that were already processed, checking an in-memory LRU
+    cache first, which lasts as long as the warm container, and then the
+    optional persistent store.
+    """
+
+    def __init__(self, max_size, store=None):
+        """
+        :param max_size: the maximal number of keys to keep in memory.
+        :param store: an optional DedupStore.
+        """
+        self.cache = LRUCache(max_size)
+        self.store = store
+
+    def claim(self, key):
+        """
+        :param key: a string key.
+        :return: whether the key should be processed, i.e. it wasn't claimed
+            before.
+        """
+        if key in self.cache:
+            return False
+        if self.store is not None and not self.store.claim(key):
+            self.cache.add(key)
+            return False
+        return self.cache.add(key)
+
+    def complete(self, key):
+        """Marks a claimed key as processed, after its processing succeeded.
+        If it fails the claim's lease expires, and the key may be processed
+        again.
+
+        :param key: a string key.
+        """
+        if self.store is not None:
+            try:
+                self.store.complete(key)
+            except Exception:
+                logger.exception('Failed completing {0}'.format(key))
+
+    def release(self, key):
+        """Releases a claimed key after its processing failed, so a retry
+        isn't skipped.
+
+        :param key: a string key.
+        """
+        self.cache.discard(key)
+        if self.store is not None:
+            try:
+                self.store.release(key)
+            except Exception:
+                logger.exception('Failed releasing {0}'.format(key))
@@ -0,0 +1,140 @@
+"""Local stand-ins for the AWS backends, for running cloudtrail_monitoring and
+the backfill without an AWS account.
+"""
+import io
+import os
+
+
+class LocalS3Client(object):
+    """Serves S3 objects from a local directory, where each bucket is a
+    sub-directory and each key a file path under it. Implements the parts of
+    the boto3 S3 client used by cloudtrail_monitoring and the backfill.
+    """
+
+    def __init__(self, root):
+        """
+        :param root: the directory holding the buckets.
+        """
+        self.root = root
+
+    def _path(self, bucket, key=''):
+        return os.path.join(self.root, bucket, *key.split('/'))
+
+    def _keys(self, bucket, prefix):
+        """
+        :return: the sorted keys of the bucket that start with the prefix.
+        """
+        # Only walk the deepest directory the prefix fully names
+        directory = prefix.rsplit('/', 1)[0] if '/' in prefix else ''
+        top = self._path(bucket, directory)
+        keys = []
+        for dir_path, _, file_names in os.walk(top):
+            for file_name in file_names:
+                path = os.path.join(dir_path, file_name)
+                key = os.path.relpath(path, self._path(bucket)).replace(
+                    os.sep, '/')
+                if key.startswith(prefix):
+                    keys.append(key)
+        return sorted(keys)
+
+    def get_object(self, Bucket, Key, **kwargs):
+        with open(self._path(Bucket, Key), 'rb') as f:
+            body = f.read()
+        return {'Body': io.BytesIO(body), 'ContentLength': len(body)}
+
+    def list_objects_v2(self, Bucket, Prefix='', Delimiter=None,
+                        ContinuationToken=None, MaxKeys=1000, **kwargs):
+        keys = self._keys(Bucket, Prefix)
+        contents = []
+        common_prefixes = []
+        for key in keys:
+            if Delimiter:
+                index = key.find(Delimiter, len(Prefix))
+                if index != -1:
+                    common_prefix = key[:index + len(Delimiter)]
+                    if not common_prefixes \
+                            or common_prefixes[-1] != common_prefix:
+                        common_prefixes.append(common_prefix)
+                    continue
+            contents.append(key)
+        start = int(ContinuationToken or 0)
+        page = contents[start:start + MaxKeys]
+        response = {
+            'Contents': [{'Key': key,
+                          'Size': os.path.getsize(self._path(Bucket, key))}
+                         for key in page],
+            # Returned once, with the first page
+            'CommonPrefixes': [{'Prefix': common_prefix}
+                               for common_prefix in common_prefixes
+                               if start == 0],
+            'KeyCount': len(page),
+            'IsTruncated': start + MaxKeys < len(contents)
+        }
+        if response['IsTruncated']:
+            response['NextContinuationToken'] = str(start + MaxKeys)
+        return response
+
+    def get_paginator(self, operation_name):
+        if operation_name != 'list_objects_v2':
+            raise NotImplementedError(operation_name)
+        return LocalPaginator(self.list_objects_v2)
+
+
+class LocalPaginator(object):
+    """A paginator over the continuation tokens of a list operation.
+    """
+
+    def __init__(self, operation):
+        self.operation = operation
+
+    def paginate(self, **kwargs):
+        kwargs = dict(kwargs)
+        while True:
+            page = self.operation(**kwargs)
+            yield page
+            if not page.get('IsTruncated'):
+                break
+            kwargs['ContinuationToken'] = page['NextContinuationToken']
+
+
+class LocalSNSClient(object):
+    """Records the messages published to it instead of sending them.
+    """
+
+    def __init__(self):
+        self.published = []
+
+    def publish(self, TopicArn, Subject, Message, **kwargs):
+        self.published.append({'TopicArn': TopicArn, 'Subject': Subject,
+                               'Message': Message})
+        return {'MessageId': str(len(self.published))}
+
+
+class LocalSpreadsheet(object):
+    """Records the rows appended to its worksheets.
+    """
+
+    def __init__(self):
+        self.rows = {}
+        self.requests = 0
+
+    def worksheet(self, title):
+        return LocalWorksheet(self, title)
+
+    def values_append(self, range, params=None, body=None):
+        self.requests += 1
+        title = range.split('!')[0].strip("'")
+        self.rows.setdefault(title, []).extend(body['values'])
+        return {'updates': {'updatedRows': len(body['values'])}}
+
+
+class LocalWorksheet(object):
+    """A worksheet of a LocalSpreadsheet.
+    """
+
+    def __init__(self, spreadsheet, title):
+        self.spreadsheet = spreadsheet
+        self.title = title
+
+    def append_row(self, values):
+        self.spreadsheet.values_append(self.title, body={'values': [values]})
@@ -1,23 +1,37 @@
 import os
 import re
 import json
-import gzip
 import logging
-import tempfile
 import time
+import hashlib
+import calendar
+import threading
+from contextlib import contextmanager
 from datetime import datetime
+from multiprocessing.dummy import Pool as ThreadPool
 
 import boto3
 import botocore
+import botocore.exceptions
 import gspread
 from oauth2client.service_account import ServiceAccountCredentials
 
+from cloudtrail_archive import Archive
+from cloudtrail_dedup import Deduplicator, DynamoDBDedupStore
+from cloudtrail_rules import RuleSet, decompress_stream, parse_records
+
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 CONFIG_FILE_PATH = os.environ.get('CONFIG_FILE_PATH')
-if not CONFIG_FILE_PATH:
-    raise Exception('No CONFIG_FILE_PATH provided in OS ENV VARS')
+# Optional S3-hosted config, used instead of CONFIG_FILE_PATH
+CONFIG_S3_BUCKET = os.environ.get('CONFIG_S3_BUCKET')
+CONFIG_S3_KEY = os.environ.get('CONFIG_S3_KEY')
+if not CONFIG_FILE_PATH and not (CONFIG_S3_BUCKET and CONFIG_S3_KEY):
+    raise Exception('No CONFIG_FILE_PATH or CONFIG_S3_BUCKET and '
+                    'CONFIG_S3_KEY provided in OS ENV VARS')
+# How often a warm container checks whether the config changed (seconds)
+CONFIG_CHECK_INTERVAL = int(os.environ.get('CONFIG_CHECK_INTERVAL', 60))
 ROLE_SESSION_NAME = os.environ.get('ROLE_SESSION_NAME')
 if not ROLE_SESSION_NAME:
     raise Exception('No ROLE_SESSION_NAME provided in OS ENV VARS')
@@ -32,6 +46,9 @@ if not SPREADSHEET_ID:
 WORKSHEET_NAME = os.environ.get('WORKSHEET_NAME')
 if not WORKSHEET_NAME:
     raise Exception('No WORKSHEET_NAME provided in OS ENV VARS')
+# Kept across warm invocations, see get_worksheet()
+gspread_client = None
+worksheet = None
 COLUMNS = {
     'BUCKET_NAME': 0,
     'CREATED_BY': 1,
@@ -48,36 +65,195 @@ ACCOUNT_DETAILS = {
               'BucketName': os.getenv('22222' + '_BucketName')},
 }
 
+# Account number -> S3 client, created on first use, see get_s3_client()
 S3_CLIENTS = {
 }
-# In seconds
-REFRESH_PERIOD = 3500
-BOTOCORE_CONFIG = botocore.client.Config(connect_timeout=5, read_timeout=5)
+# Account number -> expiration of the S3 client's credentials (epoch seconds)
+S3_CLIENTS_EXPIRATION = {
+}
+CREDENTIALS_LOCKS = dict(
+    (account_num, threading.Lock()) for account_num in ACCOUNT_DETAILS)
+# Refresh the assumed role credentials this long before they expire (seconds)
+CREDENTIALS_REFRESH_MARGIN = int(
+    os.environ.get('CREDENTIALS_REFRESH_MARGIN', 300))
+# Concurrent S3 downloads per invocation
+FETCH_WORKERS = int(os.environ.get('FETCH_WORKERS', 8))
+# Whether the events keep the order of their objects in the notification
+FETCH_ORDERED = os.environ.get('FETCH_ORDERED', 'true').lower() == 'true'
+# Processed objects and events remembered by a warm container
+DEDUP_CACHE_SIZE = int(os.environ.get('DEDUP_CACHE_SIZE', 10000))
+# Optional DynamoDB table that remembers them across containers
+DEDUP_TABLE = os.environ.get('DEDUP_TABLE')
+# How long the DynamoDB table remembers them (seconds)
+DEDUP_TTL = int(os.environ.get('DEDUP_TTL', 7 * 86400))
+# How long the DynamoDB table keeps them claimed while they're processed
+# (seconds), at least the function's timeout. Claims of an invocation that
+# timed out or crashed expire after it, so its retry processes them.
+DEDUP_LEASE = int(os.environ.get('DEDUP_LEASE', 900))
+# 'each' publishes every notification, 'digest' one summary per topic
+NOTIFICATION_MODE = os.environ.get('NOTIFICATION_MODE', 'each')
+# In digest mode, how long notifications are collected before publishing
+# (seconds), 0 publishes at the end of every invocation. With a window, the
+# function should also be invoked by a scheduled CloudWatch Events rule, which
+# publishes the digests that are due when no logs arrive.
+DIGEST_WINDOW = int(os.environ.get('DIGEST_WINDOW', 0))
+# Where the pending digests are kept. /tmp lasts only as long as the
+# container, so pending notifications are lost when it's recycled, even
+# though their events won't be processed again.
+DIGEST_STORE_PATH = os.environ.get('DIGEST_STORE_PATH',
+                                   '/tmp/cloudtrail_monitoring_digest.json')
+# SNS limits
+MAX_SUBJECT_LENGTH = 100
+MAX_MESSAGE_SIZE = 262144
+# Optional archive of the full matched records, in a local directory or,
+# if ARCHIVE_S3_BUCKET is set, in S3
+ARCHIVE_ROOT = os.environ.get('ARCHIVE_ROOT')
+ARCHIVE_S3_BUCKET = os.environ.get('ARCHIVE_S3_BUCKET')
+ARCHIVE_S3_PREFIX = os.environ.get('ARCHIVE_S3_PREFIX', '')
+BOTOCORE_CONFIG = botocore.client.Config(
+    connect_timeout=5, read_timeout=5,
+    max_pool_connections=max(10, FETCH_WORKERS))
+sts_client = None
+config_s3_client = None
+deduplicator = None
+archive = None
+# Region -> SNS client, see get_sns_client()
+SNS_CLIENTS = {
+}
+# The compiled rule set, kept across warm invocations, see get_rule_set().
+# 'version' is the config's mtime and content hash, or its S3 ETag.
+CONFIG_CACHE = {
+    'rule_set': None,
+    'version': None,
+    'checked_at': 0
+}
+
+
+class InvocationStats(object):
+    """Accumulates the time spent in each stage of an invocation, and some
+    counters. Stages that run in the download threads are summed across the
+    threads.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.stages = {}
+        self.counters = {}
+
+    @contextmanager
+    def timed(self, stage):
+        """Times the enclosed block as part of the given stage.
 
+        :param stage: the stage name.
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.time() - start)
 
-def set_credentials(sts_client):
-    """Sets the S3 CLIENTS dictionary.
+    def add_time(self, stage, seconds):
+        with self._lock:
+            self.stages[stage] = self.stages.get(stage, 0) + seconds
 
-    :param sts_client: sts client to use.
+    def count(self, counter, n=1):
+        with self._lock:
+            self.counters[counter] = self.counters.get(counter, 0) + n
+
+
+class TimedReader(object):
+    """Wraps a file-like object, timing its reads as the download stage.
     """
-    for account_num, account_details in ACCOUNT_DETAILS.items():
-        cred = sts_client.assume_role(
-            RoleArn=account_details['RoleArn'],
-            RoleSessionName=ROLE_SESSION_NAME)['Credentials']
-        boto3_kwargs = {
-            'aws_access_key_id': cred['AccessKeyId'],
-            'aws_secret_access_key': cred['SecretAccessKey'],
-            'aws_session_token': cred['SessionToken']
-        }
-        S3_CLIENTS[account_num] = boto3.client('s3',
-                                               config=BOTOCORE_CONFIG,
-                                               **boto3_kwargs)
-    global credentials_last_refresh
-    credentials_last_refresh = time.time()
 
+    def __init__(self, stream):
+        self.stream = stream
+        self.elapsed = 0
+
+    def read(self, *args):
+        start = time.time()
+        data = self.stream.read(*args)
+        self.elapsed += time.time() - start
+        return data
 
-sts_client = boto3.client('sts', config=BOTOCORE_CONFIG)
-set_credentials(sts_client)
+
+STATS = InvocationStats()
+
+
+def get_sts_client():
+    """
+    :return: the STS client, created on first use.
+    """
+    global sts_client
+    if sts_client is None:
+        sts_client = boto3.client('sts', config=BOTOCORE_CONFIG)
+    return sts_client
+
+
+def is_s3_client_fresh(account_num):
+    """
+    :param account_num: the account number.
+    :return: whether the account has an S3 client whose credentials won't
+        expire within the refresh margin.
+    """
+    expiration = S3_CLIENTS_EXPIRATION.get(account_num)
+    return expiration is not None \
+        and expiration - time.time() > CREDENTIALS_REFRESH_MARGIN
+
+
+def get_s3_client(account_num):
+    """Returns the S3 client of the account, assuming the account's role only
+    when there's no client yet or its credentials are about to expire.
+
+    :param account_num: the account number.
+    :return: the S3 client.
+    """
+    if is_s3_client_fresh(account_num):
+        return S3_CLIENTS[account_num]
+    with CREDENTIALS_LOCKS[account_num]:
+        # Another thread may have refreshed it while waiting for the lock
+        if not is_s3_client_fresh(account_num):
+            cred = get_sts_client().assume_role(
+                RoleArn=ACCOUNT_DETAILS[account_num]['RoleArn'],
+                RoleSessionName=ROLE_SESSION_NAME)['Credentials']
+            boto3_kwargs = {
+                'aws_access_key_id': cred['AccessKeyId'],
+                'aws_secret_access_key': cred['SecretAccessKey'],
+                'aws_session_token': cred['SessionToken']
+            }
+            S3_CLIENTS[account_num] = boto3.client('s3',
+                                                   config=BOTOCORE_CONFIG,
+                                                   **boto3_kwargs)
+            S3_CLIENTS_EXPIRATION[account_num] = calendar.timegm(
+                cred['Expiration'].utctimetuple())
+            logger.info('Assumed the role of account {0}'.format(
+                account_num))
+        return S3_CLIENTS[account_num]
+
+
+def prepare_s3_clients(account_nums):
+    """Makes sure the given accounts have fresh S3 clients, assuming their
+    roles concurrently.
+
+    :param account_nums: the account numbers that are about to be used.
+    """
+    stale = []
+    for account_num in set(account_nums):
+        if account_num not in ACCOUNT_DETAILS:
+            logger.warning('Unknown account {0}'.format(account_num))
+        elif not is_s3_client_fresh(account_num):
+            stale.append(account_num)
+    if len(stale) == 1:
+        get_s3_client(stale[0])
+    elif stale:
+        pool = ThreadPool(len(stale))
+        try:
+            pool.map(get_s3_client, stale)
+        finally:
+            pool.close()
+            pool.join()
 
 
 def get_current_account_number(event):
@@ -90,169 +266,491 @@ def get_current_account_number(event):
     return pattern.findall(arn)[4]
 
 
-def get_config():
-    """Loads the config from the local path provided.
+def get_local_config(version):
+    """Reads the config from CONFIG_FILE_PATH unless it didn't change. The
+    file is only read when its mtime changes, and only parsed when its content
+    hash changes too.
 
-    :return: returns the dict representing the configuration file stored in S3.
+    :param version: the (mtime, content hash) of the cached config.
+    :return: a (version, config dict) tuple, the config is None if it didn't
+        change.
     """
-    with open(CONFIG_FILE_PATH, 'r') as f:
-        return json.load(f)
-
-
-def get_events(event):
-    """Gets the objects that were put - the ones that caused this script to be
-    invoked.
+    mtime = os.stat(CONFIG_FILE_PATH).st_mtime
+    if version is not None and version[0] == mtime:
+        return version, None
+    with open(CONFIG_FILE_PATH, 'rb') as f:
+        content = f.read()
+    content_hash = hashlib.md5(content).hexdigest()
+    if version is not None and version[1] == content_hash:
+        return (mtime, content_hash), None
+    return (mtime, content_hash), json.loads(content.decode('utf-8'))
+
+
+def get_s3_config(version):
+    """Reads the config from CONFIG_S3_BUCKET unless its ETag didn't change.
+
+    :param version: the ETag of the cached config.
+    :return: a (version, config dict) tuple, the config is None if it didn't
+        change.
+    """
+    global config_s3_client
+    if config_s3_client is None:
+        config_s3_client = boto3.client('s3', config=BOTOCORE_CONFIG)
+    kwargs = {'Bucket': CONFIG_S3_BUCKET, 'Key': CONFIG_S3_KEY}
+    if version is not None:
+        kwargs['IfNoneMatch'] = version
+    try:
+        response = config_s3_client.get_object(**kwargs)
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] in ('304', 'NotModified'):
+            return version, None
+        raise
+    content = response['Body'].read()
+    return response['ETag'], json.loads(content.decode('utf-8'))
+
+
+def get_rule_set():
+    """Returns the compiled rules of the config. The rule set is cached and
+    only rebuilt when the config changes, which is checked at most once every
+    CONFIG_CHECK_INTERVAL seconds.
+
+    :return: a RuleSet of the configured rules.
+    """
+    now = time.time()
+    if CONFIG_CACHE['rule_set'] is not None \
+            and now - CONFIG_CACHE['checked_at'] < CONFIG_CHECK_INTERVAL:
+        return CONFIG_CACHE['rule_set']
+
+    if CONFIG_S3_BUCKET and CONFIG_S3_KEY:
+        version, config = get_s3_config(CONFIG_CACHE['version'])
+    else:
+        version, config = get_local_config(CONFIG_CACHE['version'])
+    if config is not None:
+        logger.info('Fetched the following config: {0}'.format(config))
+        CONFIG_CACHE['rule_set'] = RuleSet.from_config(config)
+        logger.info('Loaded {0} rules'.format(
+            len(CONFIG_CACHE['rule_set'].rules)))
+    CONFIG_CACHE['version'] = version
+    CONFIG_CACHE['checked_at'] = now
+    return CONFIG_CACHE['rule_set']
+
+
+def get_object_refs(event):
+    """Gets the S3 objects referenced by the SNS records of the event.
 
     :param event: the given AWS event.
-    :return: a list of dicts representing the objects
+    :return: a list of (account number, bucket name, key, sequencer) tuples.
     """
-    obj_list = []
+    object_refs = []
     for obj in event['Records']:
         curr_account_num = get_current_account_number(obj)
         s3_events = obj['Sns']['Message']
         json_s3_events = json.loads(s3_events)
         if 'Records' in json_s3_events:
             for s3_event in json_s3_events['Records']:
-                obj_list.extend(
-                    get_raw_events(S3_CLIENTS[curr_account_num],
-                                   s3_event['s3']['object']['key'],
-                                   s3_event['s3']['bucket']['name']))
+                object_refs.append((curr_account_num,
+                                    s3_event['s3']['bucket']['name'],
+                                    s3_event['s3']['object']['key'],
+                                    s3_event['s3']['object'].get(
+                                        'sequencer')))
+    return object_refs
+
+
+def get_deduplicator():
+    """
+    :return: the Deduplicator of processed objects and events, created on
+        first use and kept across warm invocations.
+    """
+    global deduplicator
+    if deduplicator is None:
+        store = None
+        if DEDUP_TABLE:
+            store = DynamoDBDedupStore(
+                boto3.client('dynamodb', config=BOTOCORE_CONFIG),
+                DEDUP_TABLE,
+                DEDUP_TTL,
+                DEDUP_LEASE)
+        deduplicator = Deduplicator(DEDUP_CACHE_SIZE, store)
+    return deduplicator
+
+
+def get_archive():
+    """
+    :return: the Archive of matched records, or None if archiving isn't
+        configured.
+    """
+    global archive
+    if archive is None and (ARCHIVE_ROOT or ARCHIVE_S3_BUCKET):
+        s3_client = None
+        if ARCHIVE_S3_BUCKET:
+            s3_client = boto3.client('s3', config=BOTOCORE_CONFIG)
+        archive = Archive(ARCHIVE_ROOT, s3_client, ARCHIVE_S3_BUCKET,
+                          ARCHIVE_S3_PREFIX)
+    return archive
+
+
+def get_object_dedup_key(object_ref):
+    """
+    :param object_ref: an (account number, bucket name, key, sequencer)
+        tuple.
+    :return: the key identifying the object's notification.
+    """
+    return 'object:{1}/{2}@{3}'.format(*object_ref)
+
+
+def get_event_dedup_key(event):
+    """
+    :param event: a CloudTrail record.
+    :return: the key identifying the record.
+    """
+    return 'event:{0}'.format(event['eventID'])
+
+
+def get_events(event, rule_set=None, ordered=FETCH_ORDERED,
+               max_workers=FETCH_WORKERS, claimed_keys=None):
+    """Gets the objects that were put - the ones that caused this script to be
+    invoked. Objects that were already processed are skipped before
+    downloading. The objects are downloaded concurrently, and an object that
+    fails to download or parse is logged and skipped.
+
+    :param event: the given AWS event.
+    :param rule_set: if given, only the records that may match its rules are
+        returned.
+    :param ordered: whether to keep the records in the order of the objects
+        in the event, otherwise they're returned as the downloads complete.
+    :param max_workers: the maximal number of concurrent downloads.
+    :param claimed_keys: if given, the dedup keys of the fetched objects are
+        appended to it.
+    :return: a list of dicts representing the objects
+    """
+    dedup = get_deduplicator()
+    object_refs = []
+    try:
+        for object_ref in get_object_refs(event):
+            if dedup.claim(get_object_dedup_key(object_ref)):
+                object_refs.append(object_ref)
+            else:
+                logger.info('Skipping already processed s3://{1}/{2}'.format(
+                    *object_ref))
+        if not object_refs:
+            return []
+        prepare_s3_clients(object_ref[0] for object_ref in object_refs)
+    except Exception:
+        # None of the objects were fetched, let the retry fetch them
+        for object_ref in object_refs:
+            dedup.release(get_object_dedup_key(object_ref))
+        raise
+
+    def fetch(object_ref):
+        account_num, bucket_name, key, _ = object_ref
+        try:
+            raw_events = get_raw_events(get_s3_client(account_num), key,
+                                        bucket_name, rule_set)
+        except Exception:
+            logger.exception('Failed fetching s3://{0}/{1} of account '
+                             '{2}'.format(bucket_name, key, account_num))
+            dedup.release(get_object_dedup_key(object_ref))
+            return []
+        if claimed_keys is not None:
+            claimed_keys.append(get_object_dedup_key(object_ref))
+        return raw_events
+
+    obj_list = []
+    pool = ThreadPool(min(max_workers, len(object_refs)))
+    try:
+        if ordered:
+            results = pool.imap(fetch, object_refs)
+        else:
+            results = pool.imap_unordered(fetch, object_refs)
+        for raw_events in results:
+            obj_list.extend(raw_events)
+    finally:
+        pool.close()
+        pool.join()
 
     return obj_list
 
 
-def get_raw_events(s3client, key, bucket_name):
+def get_raw_events(s3client, key, bucket_name, rule_set=None):
     """Returns a python object from a compressed file.
 
     :param s3client: the boto3 client to be used.
     :param key: the key of the file to be downloaded.
     :param bucket_name: bucket name to download from.
+    :param rule_set: if given, only the records that may match its rules are
+        decoded.
     :return: the raw python object underneath.
     """
-    raw_file = ''
-    fd, path = tempfile.mkstemp()
-    os.close(fd)
-    with open(path, 'wb') as tmp:
-        # s3client.download_fileobj(FILTER_CONFIG_BUCKET, key, tmp)
-        tmp.write(s3client.get_object(
-            Bucket=bucket_name,
-            Key=key)['Body'].read())
-        logger.info('get_raw_events() after get_object')
-
-    with gzip.open(path, 'r') as gz_file:
-        for line in gz_file:
-            raw_file += line
-    json_file = json.loads(raw_file)
-    if 'Records' in json_file:
-        return json.loads(raw_file)['Records']
-    return []
-
-
-def event_matches_config(config, target_object):
-    """Checks if the pattern configured in config matches anything at
-    target_object.
-
-    :param config: the configuration which holds the relevant regex
-    :param target_object: the object to be searched
-    :return: a boolean representing whether the regex was a match or not
-    """
-    match = False
-    s_target_object = json.dumps(target_object)
-
-    for source in config['source']:
-        match |= source in target_object['eventSource']
-        if match:
-            break
-    if match:
-        for include in config['includes']:
-            match &= include in s_target_object
-        for not_include in config['not_includes']:
-            if not_include in s_target_object:
-                return False
-
-    return match
-
-
-def get_notification(matched_obj):
-    """Notifies via AWS SNS.
-
-    :param matched_obj: the object that the notification should notify about
+    start = time.time()
+    body = TimedReader(s3client.get_object(
+        Bucket=bucket_name,
+        Key=key)['Body'])
+    get_object_time = time.time() - start
+    logger.info('get_raw_events() after get_object')
+    start = time.time()
+    raw = decompress_stream(body)
+    STATS.add_time('download', get_object_time + body.elapsed)
+    STATS.add_time('decompress', time.time() - start - body.elapsed)
+    with STATS.timed('parse'):
+        records = parse_records(raw, rule_set)
+    STATS.count('objects')
+    STATS.count('records', len(records))
+    return records
+
+
+def get_sns_client(region):
     """
-    subject = \
-        'S3 notification: new bucket created {0}'.format(
-            matched_obj['requestParameters']
-            ['bucketName'])
-    message = \
-        'New bucket created in account: {0}.\nBucket name: {1}\n' \
-        'ARN of the creator: {2}\n' \
-        'Region: {3}'.format(matched_obj['recipientAccountId'],
-                             matched_obj['requestParameters']['bucketName'],
-                             matched_obj['userIdentity']['arn'],
-                             matched_obj['awsRegion'])
-
-    return {subject: message}
+    :param region: the SNS region.
+    :return: the region's SNS client, created on first use and kept across
+        warm invocations.
+    """
+    if region not in SNS_CLIENTS:
+        SNS_CLIENTS[region] = boto3.client('sns', region_name=region,
+                                           config=BOTOCORE_CONFIG)
+    return SNS_CLIENTS[region]
 
 
-def notify(config, subject, message):
+def notify(sns_config, subject, message):
     """Notifies via AWS SNS.
 
-    :param config: the configuration which contains the SNS topic ARN
+    :param sns_config: a dict with the SNS 'region' and 'topicARN'.
     :param subject: the subject to publish with
     :param message: the message to publish with
     """
-    snsclient = boto3.client('sns', region_name=config['sns']['region'])
+    snsclient = get_sns_client(sns_config['region'])
     snsclient.publish(
-        TopicArn=config['sns']['topicARN'],
-        Subject=subject,
+        TopicArn=sns_config['topicARN'],
+        Subject=subject[:MAX_SUBJECT_LENGTH],
         Message=message)
     logger.info('Message "{0}" was sent to {1}'.format(
-        message, config['sns']['topicARN']))
+        message, sns_config['topicARN']))
 
 
-def add_row(values):
-    """Adds a row with the given values.
+def get_digest(notifications):
+    """Summarizes several notifications into a single one.
 
-    :param values: values to add (each value is a column).
+    :param notifications: a list of (subject, message) tuples.
+    :return: a (subject, message) tuple.
     """
-    credentials = ServiceAccountCredentials.from_json_keyfile_name(
-        CREDENTIALS_FILE_PATH, scopes=SCOPES)
-    gc = gspread.authorize(credentials)
-    sheet = gc.open_by_key(SPREADSHEET_ID).worksheet(WORKSHEET_NAME)
-    sheet.append_row(values)
+    if len(notifications) == 1:
+        return notifications[0]
+    subject = 'CloudTrail notifications: {0} events'.format(
+        len(notifications))
+    parts = ['{0} events:\n'.format(len(notifications))]
+    parts.extend('- ' + notify_subject for notify_subject, _ in notifications)
+    size = sum(len(part) + 1 for part in parts)
+    for i, (notify_subject, message) in enumerate(notifications):
+        part = '\n{0}\n{1}\n{2}'.format('-' * 40, notify_subject, message)
+        if size + len(part) > MAX_MESSAGE_SIZE - 100:
+            parts.append('\n... and {0} more'.format(len(notifications) - i))
+            break
+        parts.append(part)
+        size += len(part) + 1
+    return subject, '\n'.join(parts)
 
 
-def save_event(event):
-    """Saves the event to a Google Spreadsheet.
+class DigestStore(object):
+    """Keeps pending digest notifications in a local JSON file, which lasts as
+    long as the warm container. A stand-in for a shared store: the pending
+    notifications are lost when the container is recycled, and a concurrent
+    container has its own.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: the JSON file path.
+        """
+        self.path = path
+
+    def load(self):
+        """
+        :return: a dict of topic ARN -> {'sns': SNS config, 'since': the time
+            of the first pending notification, 'notifications': a list of
+            [subject, message]}.
+        """
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def save(self, pending):
+        """
+        :param pending: the pending notifications, see load().
+        """
+        with open(self.path, 'w') as f:
+            json.dump(pending, f)
+
+
+def send_notifications(notifications, sns_configs, mode=NOTIFICATION_MODE,
+                       window=DIGEST_WINDOW):
+    """Sends the notifications, one message per notification or one digest
+    per topic.
+
+    :param notifications: a dict of (region, topic ARN) -> a list of
+        (subject, message) tuples.
+    :param sns_configs: a dict of (region, topic ARN) -> SNS config.
+    :param mode: 'each' to publish each notification, 'digest' to publish a
+        digest per topic.
+    :param window: in digest mode, how long to collect notifications before
+        publishing the digest (seconds). If 0, the digest is published at the
+        end of the invocation.
+    """
+    if mode != 'digest':
+        for target, target_notifications in notifications.items():
+            for notify_subject, message in target_notifications:
+                notify(sns_configs[target], notify_subject, message)
+        return
+
+    now = time.time()
+    store = DigestStore(DIGEST_STORE_PATH) if window > 0 else None
+    pending = store.load() if store else {}
+    for target, target_notifications in notifications.items():
+        topic = pending.setdefault(target[1], {'sns': sns_configs[target],
+                                               'since': now,
+                                               'notifications': []})
+        topic['notifications'].extend(
+            [notify_subject, message]
+            for notify_subject, message in target_notifications)
+
+    try:
+        for topic_arn in list(pending):
+            topic = pending[topic_arn]
+            if now - topic['since'] < window:
+                continue
+            subject, message = get_digest(
+                [tuple(n) for n in topic['notifications']])
+            notify(topic['sns'], subject, message)
+            del pending[topic_arn]
+    finally:
+        if store:
+            store.save(pending)
+
+
+def get_worksheet():
+    """Returns the worksheet to save events to. It's authorized and opened once
+    and kept across warm invocations, the access token is refreshed when it
+    expires.
+
+    :return: the gspread worksheet.
+    """
+    global gspread_client, worksheet
+    if worksheet is None:
+        credentials = ServiceAccountCredentials.from_json_keyfile_name(
+            CREDENTIALS_FILE_PATH, scopes=SCOPES)
+        gspread_client = gspread.authorize(credentials)
+        worksheet = gspread_client.open_by_key(SPREADSHEET_ID).worksheet(
+            WORKSHEET_NAME)
+    elif gspread_client.auth.access_token_expired:
+        gspread_client.login()
+    return worksheet
+
+
+def add_rows(rows):
+    """Appends the given rows in a single request.
+
+    :param rows: rows to add, each row is a list of values (each value is a
+        column).
+    """
+    global worksheet
+    if not rows:
+        return
+    sheet = get_worksheet()
+    try:
+        sheet.spreadsheet.values_append(
+            sheet.title,
+            params={'valueInputOption': 'RAW'},
+            body={'values': rows})
+    except Exception:
+        # Reopen the worksheet on the next invocation
+        worksheet = None
+        raise
+    logger.info('Added {0} rows to {1}'.format(len(rows), WORKSHEET_NAME))
+
+
+def get_row(event):
+    """Returns the Google Spreadsheet row of the event. Events that aren't
+    about a bucket get an empty bucket name rather than failing.
 
     :param event: event to save.
+    :return: the row's values.
     """
+    # requestParameters is null for some events
+    request_parameters = event.get('requestParameters') or {}
     values = [None] * len(COLUMNS.keys())
-    values[COLUMNS['BUCKET_NAME']] = event['requestParameters']['bucketName']
+    values[COLUMNS['BUCKET_NAME']] = request_parameters.get('bucketName', '')
     values[COLUMNS['CREATED_AT']] = datetime.now().strftime(
         '%m/%d/%Y %H:%M:%S')  # Matching the Google Spreadsheet format
-    values[COLUMNS['CREATED_BY']] = event['userIdentity']['arn']
+    values[COLUMNS['CREATED_BY']] = event.get('userIdentity', {}).get(
+        'arn', '')
     values[COLUMNS['WEIGHT']] = 0  # The bucket is empty when created
     values[COLUMNS['ACCOUNT']] = event['recipientAccountId']
     values[COLUMNS['REGION']] = event['awsRegion']
-    add_row(values)
+    return values
 
 
 def main(event, context):
-    if (time.time() - credentials_last_refresh) >= REFRESH_PERIOD:
-        set_credentials(sts_client)
     logger.info('Handling event: {0}'.format(event))
-    config = get_config()
-    logger.info('Fetched the following config: {0}'.format(config))
-    events = get_events(event)
-    logger.info('Checking {0} events'.format(len(events)))
-
-    notifications = {}
-    for ev in events:
-        if event_matches_config(config, ev):
-            save_event(ev)
-            notifications.update(get_notification(ev))
-
-    for notify_subject in notifications:
-        notify(config, notify_subject, notifications[notify_subject])
-
+    if event.get('source') == 'aws.events':
+        # A scheduled invocation, publishes the digests that are due
+        send_notifications({}, {})
+        return True
+    STATS.reset()
+    rule_set = get_rule_set()
+    dedup = get_deduplicator()
+    claimed_keys = []
+
+    try:
+        events = get_events(event, rule_set, claimed_keys=claimed_keys)
+        logger.info('Checking {0} events'.format(len(events)))
+        rows = []
+        matched_events = []
+        # (region, topic ARN) -> a list of (subject, message)
+        notifications = {}
+        sns_configs = {}
+        with STATS.timed('match'):
+            for ev in events:
+                rules = rule_set.match(ev)
+                if not rules:
+                    continue
+                STATS.count('matched')
+                event_key = get_event_dedup_key(ev)
+                if not dedup.claim(event_key):
+                    logger.info('Skipping already processed event '
+                                '{0}'.format(ev['eventID']))
+                    continue
+                claimed_keys.append(event_key)
+                matched_events.append(ev)
+                if any(rule.spreadsheet for rule in rules):
+                    rows.append(get_row(ev))
+                for rule in rules:
+                    subject, message = rule.get_notification(ev)
+                    notifications.setdefault(rule.target, []).append(
+                        (subject, message))
+                    sns_configs[rule.target] = rule.sns
+
+        with STATS.timed('save'):
+            add_rows(rows)
+        with STATS.timed('notify'):
+            send_notifications(notifications, sns_configs)
+    except Exception:
+        # Let the retry of this invocation process them again
+        for key in claimed_keys:
+            dedup.release(key)
+        raise
+    for key in claimed_keys:
+        dedup.complete(key)
+
+    # Not retried, since the rows and notifications were already sent and a
+    # retry would duplicate them
+    try:
+        if matched_events and get_archive() is not None:
+            with STATS.timed('archive'):
+                get_archive().append(matched_events)
+    except Exception:
+        logger.exception('Failed archiving {0} events'.format(
+            len(matched_events)))
+
+    logger.info('Stage timings: {0}, counters: {1}'.format(
+        STATS.stages, STATS.counters))
     return True
@@ -0,0 +1,324 @@
+import re
+import zlib
+import json
+import logging
+
+logger = logging.getLogger()
+
+# Every CloudTrail record starts with this, and it can't appear inside a
+# JSON string since the quotes would be escaped.
+RECORD_START = b'{"eventVersion":'
+# Includes made of these characters appear verbatim in the raw log file
+# whenever they appear in the decoded record.
+SAFE_LITERAL = re.compile(r'^[A-Za-z0-9_.@-]+$')
+# zlib window bits that expect a gzip header
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+DECOMPRESS_CHUNK_SIZE = 1024 * 1024
+
+DEFAULT_SUBJECT = 'CloudTrail notification: {eventName} ({eventSource})'
+DEFAULT_MESSAGE = 'Event {eventName} from {eventSource} in account: ' \
+                  '{recipientAccountId}.\n' \
+                  'ARN of the caller: {userIdentity[arn]}\n' \
+                  'Region: {awsRegion}'
+# The notification of the old single rule configuration format
+NEW_BUCKET_SUBJECT = 'S3 notification: new bucket created ' \
+                     '{requestParameters[bucketName]}'
+NEW_BUCKET_MESSAGE = 'New bucket created in account: ' \
+                     '{recipientAccountId}.\n' \
+                     'Bucket name: {requestParameters[bucketName]}\n' \
+                     'ARN of the creator: {userIdentity[arn]}\n' \
+                     'Region: {awsRegion}'
+
+
+class RuleConfigException(Exception):
+    """Raised when the rules configuration is invalid.
+    """
+    pass
+
+
+class Rule(object):
+    """A single monitoring rule and its notification target.
+    """
+
+    def __init__(self, name, rule_config):
+        """Initializes a rule from its configuration.
+
+        :param name: the rule name, used in logs.
+        :param rule_config: a dict with the following keys:
+            source - a list of eventSource values (optional, any source if
+                empty).
+            event_names - a list of eventName values (optional, any event name
+                if empty).
+            includes - strings that must all appear in the record.
+            not_includes - strings that must not appear in the record.
+            sns - a dict with the 'region' and 'topicARN' to notify.
+            spreadsheet - whether to save the matched record to the Google
+                Spreadsheet.
+            subject, message - str.format templates, formatted with the
+                record's fields.
+        """
+        if 'sns' not in rule_config:
+            raise RuleConfigException(
+                'Rule {0} has no sns target'.format(name))
+        self.name = name
+        self.sources = tuple(rule_config.get('source', []))
+        self.event_names = tuple(rule_config.get('event_names', []))
+        self.includes = tuple(rule_config.get('includes', []))
+        self.not_includes = tuple(rule_config.get('not_includes', []))
+        self.sns = rule_config['sns']
+        self.spreadsheet = rule_config.get('spreadsheet', False)
+        self.subject = rule_config.get('subject', DEFAULT_SUBJECT)
+        self.message = rule_config.get('message', DEFAULT_MESSAGE)
+
+    @property
+    def target(self):
+        """
+        :return: a hashable (region, topic ARN) notification target.
+        """
+        return self.sns['region'], self.sns['topicARN']
+
+    def matches(self, s_record):
+        """Checks the includes and not_includes of the rule. The eventSource
+        and eventName are already checked by the RuleSet index.
+
+        :param s_record: the record serialized to a string.
+        :return: whether the record matches.
+        """
+        for include in self.includes:
+            if include not in s_record:
+                return False
+        for not_include in self.not_includes:
+            if not_include in s_record:
+                return False
+        return True
+
+    def get_notification(self, record):
+        """Formats the notification of a matched record.
+
+        :param record: the matched CloudTrail record.
+        :return: a (subject, message) tuple.
+        """
+        try:
+            return self.subject.format(**record), \
+                self.message.format(**record)
+        except (KeyError, IndexError, TypeError, AttributeError):
+            logger.warning('Rule {0}: could not format the notification of '
+                           'event {1}'.format(self.name,
+                                              record.get('eventID')))
+            return 'CloudTrail notification: {0}'.format(self.name), \
+                json.dumps(record, indent=2)
+
+    def literal_groups(self):
+        """Returns the literals the raw bytes of a matching record must
+        contain. The record may match only if each group has at least one of
+        its literals in the record.
+
+        :return: a list of tuples of bytes, the most selective group first.
+        """
+        groups = []
+        if self.event_names:
+            groups.append(tuple(_quote(name) for name in self.event_names))
+        if self.sources:
+            groups.append(tuple(_quote(source) for source in self.sources))
+        for include in self.includes:
+            if SAFE_LITERAL.match(include):
+                groups.append((include.encode('utf-8'),))
+        return groups
+
+
+def _quote(value):
+    """
+    :param value: a string value.
+    :return: the value as a JSON string, in bytes.
+    """
+    return json.dumps(value).encode('utf-8')
+
+
+class RuleSet(object):
+    """A set of rules, indexed by eventSource and eventName so each record is
+    only checked against the rules that can match it.
+    """
+
+    def __init__(self, rules):
+        """
+        :param rules: a list of Rule objects.
+        """
+        self.rules = list(rules)
+        # (eventSource, eventName) -> rules
+        self._by_source_and_name = {}
+        # eventSource -> rules with no event names
+        self._by_source = {}
+        # eventName -> rules with no sources
+        self._by_name = {}
+        # Rules with neither sources nor event names
+        self._catch_all = []
+
+        for rule in self.rules:
+            if rule.sources and rule.event_names:
+                for source in rule.sources:
+                    for event_name in rule.event_names:
+                        self._by_source_and_name.setdefault(
+                            (source, event_name), []).append(rule)
+            elif rule.sources:
+                for source in rule.sources:
+                    self._by_source.setdefault(source, []).append(rule)
+            elif rule.event_names:
+                for event_name in rule.event_names:
+                    self._by_name.setdefault(event_name, []).append(rule)
+            else:
+                self._catch_all.append(rule)
+
+        # A rule without literals could match any record, in which case
+        # there is nothing to prefilter by.
+        self._literal_groups = [rule.literal_groups() for rule in self.rules]
+        self._anchor_re = None
+        if self._literal_groups and all(self._literal_groups):
+            anchors = set()
+            for groups in self._literal_groups:
+                anchors.update(groups[0])
+            self._anchor_re = re.compile(b'|'.join(
+                re.escape(anchor)
+                for anchor in sorted(anchors, key=len, reverse=True)))
+
+    @classmethod
+    def from_config(cls, config):
+        """Builds a rule set from a config dict. A config without a 'rules'
+        list is treated as a single rule, the old configuration format, which
+        saves its matches to the spreadsheet.
+
+        :param config: the loaded configuration.
+        :return: a RuleSet.
+        """
+        if 'rules' not in config:
+            legacy = dict(config)
+            legacy.setdefault('spreadsheet', True)
+            legacy.setdefault('subject', NEW_BUCKET_SUBJECT)
+            legacy.setdefault('message', NEW_BUCKET_MESSAGE)
+            return cls([Rule('default', legacy)])
+        rules = []
+        for i, rule_config in enumerate(config['rules']):
+            rules.append(Rule(rule_config.get('name', 'rule{0}'.format(i)),
+                              rule_config))
+        return cls(rules)
+
+    def candidates(self, record):
+        """
+        :param record: a CloudTrail record.
+        :return: the rules that may match the record.
+        """
+        source = record.get('eventSource')
+        event_name = record.get('eventName')
+        return self._by_source_and_name.get((source, event_name), []) \
+            + self._by_source.get(source, []) \
+            + self._by_name.get(event_name, []) \
+            + self._catch_all
+
+    def match(self, record):
+        """
+        :param record: a CloudTrail record.
+        :return: a list of the rules that match the record.
+        """
+        candidates = self.candidates(record)
+        if not candidates:
+            return []
+        s_record = json.dumps(record)
+        return [rule for rule in candidates if rule.matches(s_record)]
+
+    def _may_match(self, raw_record):
+        """
+        :param raw_record: the raw bytes of a single record.
+        :return: whether any of the rules may match the record.
+        """
+        for groups in self._literal_groups:
+            for group in groups:
+                if not any(literal in raw_record for literal in group):
+                    break
+            else:
+                return True
+        return False
+
+    def prefilter(self, raw):
+        """Finds the records that may match without decoding the whole log
+        file. The raw bytes are scanned once for the rules' most selective
+        literals, and only the records around the hits are decoded.
+
+        :param raw: the decompressed bytes of a CloudTrail log file.
+        :return: a list of candidate records, or None if the file can't be
+            prefiltered and should be fully decoded.
+        """
+        if not self.rules:
+            return []
+        if self._anchor_re is None:
+            return None
+        decoder = json.JSONDecoder()
+        records = []
+        record_end = 0
+        for hit in self._anchor_re.finditer(raw):
+            if hit.start() < record_end:
+                # The hit is within a record that was already checked
+                continue
+            record_start = raw.rfind(RECORD_START, 0,
+                                     hit.start() + len(RECORD_START))
+            if record_start == -1:
+                if RECORD_START not in raw:
+                    return None
+                # A hit before the first record
+                continue
+            record_end = raw.find(RECORD_START, record_start + 1)
+            if record_end == -1:
+                record_end = len(raw)
+            raw_record = raw[record_start:record_end]
+            if not self._may_match(raw_record):
+                continue
+            try:
+                record = decoder.raw_decode(raw_record.decode('utf-8'))[0]
+            except ValueError:
+                return None
+            if not isinstance(record, dict) or 'eventVersion' not in record:
+                return None
+            records.append(record)
+        return records
+
+
+def decompress_stream(stream, chunk_size=DECOMPRESS_CHUNK_SIZE):
+    """Decompresses a gzipped log file while reading it, so the compressed
+    file is never held in memory as a whole.
+
+    :param stream: a file-like object of the gzipped log file, e.g. the Body
+        of an S3 get_object response.
+    :param chunk_size: how much to read at a time.
+    :return: the decompressed bytes.
+    """
+    chunks = []
+    decompressor = zlib.decompressobj(GZIP_WBITS)
+    while True:
+        data = stream.read(chunk_size)
+        if not data:
+            break
+        while data:
+            chunks.append(decompressor.decompress(data))
+            data = decompressor.unused_data
+            if data:
+                # The file has another gzip member
+                chunks.append(decompressor.flush())
+                decompressor = zlib.decompressobj(GZIP_WBITS)
+    chunks.append(decompressor.flush())
+    return b''.join(chunks)
+
+
+def parse_records(raw, rule_set=None):
+    """Parses the records of a CloudTrail log file.
+
+    :param raw: the decompressed bytes of the log file.
+    :param rule_set: if given, only the records that may match one of its
+        rules are decoded and returned.
+    :return: a list of records.
+    """
+    if rule_set is not None:
+        records = rule_set.prefilter(raw)
+        if records is not None:
+            return records
+    json_file = json.loads(raw.decode('utf-8'))
+    if 'Records' in json_file:
+        return json_file['Records']
+    return []
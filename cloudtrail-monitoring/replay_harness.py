@@ -0,0 +1,185 @@
+"""Replays a directory of gzipped CloudTrail log files through
+cloudtrail_monitoring.main() with local S3, SNS and spreadsheet backends, and
+reports its throughput, e.g.:
+
+    python replay_harness.py --logs-dir ./logs \
+        --config cloudtrail_monitoring_config.json --batch-size 10
+
+The logs can be generated with benchmark_prefilter.generate_digest() or
+copied from a trail's bucket. Stage timings of the download threads are
+summed across the threads.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+from multiprocessing import Pool
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+TOPIC_ARN = 'arn:aws:sns:eu-west-1:{0}:cloudtrail-logs'
+STAGES = ['download', 'decompress', 'parse', 'match', 'save', 'notify',
+          'archive']
+
+
+def set_environment(config_path):
+    """Sets the env vars cloudtrail_monitoring requires at import.
+
+    :param config_path: the rules config path.
+    """
+    os.environ['CONFIG_FILE_PATH'] = os.path.abspath(config_path)
+    for name in ('ROLE_SESSION_NAME', 'CREDENTIALS_FILE_PATH',
+                 'SPREADSHEET_ID', 'WORKSHEET_NAME'):
+        os.environ.setdefault(name, 'replay')
+    os.environ.pop('CONFIG_S3_BUCKET', None)
+    os.environ.pop('DEDUP_TABLE', None)
+    os.environ.pop('ARCHIVE_S3_BUCKET', None)
+
+
+def get_log_keys(logs_dir):
+    """
+    :param logs_dir: a directory of gzipped CloudTrail log files.
+    :return: the sorted keys of the log files, relative to the directory.
+    """
+    keys = []
+    for dir_path, _, file_names in os.walk(logs_dir):
+        for file_name in file_names:
+            if file_name.endswith('.gz'):
+                path = os.path.join(dir_path, file_name)
+                keys.append(os.path.relpath(path, logs_dir).replace(
+                    os.sep, '/'))
+    return sorted(keys)
+
+
+def get_envelopes(bucket, keys, account, batch_size):
+    """Builds the SNS events that S3 notifications of the log files would
+    trigger.
+
+    :param bucket: the bucket name.
+    :param keys: the log files' keys.
+    :param account: the account number of the SNS topic.
+    :param batch_size: the number of log files per SNS event.
+    :return: a list of Lambda events.
+    """
+    envelopes = []
+    for i in range(0, len(keys), batch_size):
+        s3_records = [{'s3': {'bucket': {'name': bucket},
+                              'object': {'key': key,
+                                         'sequencer': '{0:016X}'.format(j)}}}
+                      for j, key in enumerate(keys[i:i + batch_size], i)]
+        envelopes.append({'Records': [{
+            'Sns': {'TopicArn': TOPIC_ARN.format(account),
+                    'Message': json.dumps({'Records': s3_records})}}]})
+    return envelopes
+
+
+def count_records(logs_dir, keys):
+    """Decodes every record of the log files, so it's run in a child process
+    to keep it out of the replay's peak memory.
+
+    :param logs_dir: the directory of the log files.
+    :param keys: the log files' keys.
+    :return: the total number of records in the log files.
+    """
+    from cloudtrail_rules import decompress_stream, parse_records
+    total = 0
+    for key in keys:
+        with open(os.path.join(logs_dir, *key.split('/')), 'rb') as f:
+            total += len(parse_records(decompress_stream(f)))
+    return total
+
+
+def install_backends(cm, s3_client):
+    """Replaces cloudtrail_monitoring's AWS and Google backends with local
+    ones.
+
+    :param cm: the cloudtrail_monitoring module.
+    :param s3_client: the S3 client to serve the log files.
+    :return: the local SNS client and spreadsheet.
+    """
+    from cloudtrail_local import LocalSNSClient, LocalSpreadsheet
+    sns_client = LocalSNSClient()
+    spreadsheet = LocalSpreadsheet()
+    worksheet = spreadsheet.worksheet(cm.WORKSHEET_NAME)
+    cm.get_s3_client = lambda account_num: s3_client
+    cm.prepare_s3_clients = lambda account_nums: None
+    cm.get_sns_client = lambda region: sns_client
+    cm.get_worksheet = lambda: worksheet
+    return sns_client, spreadsheet
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Replays CloudTrail log files through '
+                    'cloudtrail_monitoring.main().')
+    parser.add_argument('--logs-dir', required=True,
+                        help='a directory of gzipped CloudTrail log files')
+    parser.add_argument('--config', required=True,
+                        help='the cloudtrail_monitoring rules config')
+    parser.add_argument('--account', default='11111',
+                        help='the account number of the SNS topic')
+    parser.add_argument('--batch-size', type=int, default=1,
+                        help='log files per SNS event')
+    parser.add_argument('--trace-memory', action='store_true',
+                        help='also report the peak Python heap, slower')
+    args = parser.parse_args()
+
+    set_environment(args.config)
+    import cloudtrail_monitoring as cm
+    from cloudtrail_local import LocalS3Client
+
+    logs_dir = os.path.abspath(args.logs_dir)
+    bucket = os.path.basename(logs_dir)
+    s3_client = LocalS3Client(os.path.dirname(logs_dir))
+    keys = get_log_keys(logs_dir)
+    if not keys:
+        sys.exit('No .gz log files in {0}'.format(logs_dir))
+    pool = Pool(1)
+    try:
+        total_records = pool.apply(count_records, (logs_dir, keys))
+    finally:
+        pool.close()
+        pool.join()
+    sns_client, spreadsheet = install_backends(cm, s3_client)
+    envelopes = get_envelopes(bucket, keys, args.account, args.batch_size)
+
+    # ru_maxrss is in kilobytes on Linux
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    if args.trace_memory and tracemalloc:
+        tracemalloc.start()
+    stages = dict((stage, 0) for stage in STAGES)
+    matched = 0
+    start = time.time()
+    for envelope in envelopes:
+        cm.main(envelope, None)
+        for stage, seconds in cm.STATS.stages.items():
+            stages[stage] = stages.get(stage, 0) + seconds
+        matched += cm.STATS.counters.get('matched', 0)
+    elapsed = time.time() - start
+
+    print('Log files: {0} in {1} invocations'.format(len(keys),
+                                                      len(envelopes)))
+    print('Records: {0}, matched: {1} ({2:.3%})'.format(
+        total_records, matched, matched / float(total_records or 1)))
+    print('Elapsed: {0:.2f}s, {1:.0f} records/sec'.format(
+        elapsed, total_records / elapsed))
+    for stage in sorted(stages, key=lambda name: (
+            STAGES.index(name) if name in STAGES else len(STAGES), name)):
+        print('  {0:>10}: {1:.3f}s'.format(stage, stages[stage]))
+    print('Spreadsheet requests: {0}, SNS messages: {1}'.format(
+        spreadsheet.requests, len(sns_client.published)))
+    print('Peak RSS: {0:.1f} MB, {1:.1f} MB before the replay'.format(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+        rss_before))
+    if args.trace_memory and tracemalloc:
+        print('Peak Python heap: {0:.1f} MB'.format(
+            tracemalloc.get_traced_memory()[1] / 1048576.0))
+
+
+if __name__ == '__main__':
+    main()
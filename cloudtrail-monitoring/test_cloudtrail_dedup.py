@@ -0,0 +1,161 @@
+import time
+import unittest
+
+from cloudtrail_dedup import (DedupStore, Deduplicator, DynamoDBDedupStore,
+                              LRUCache)
+
+
+class ConditionalCheckFailedException(Exception):
+    pass
+
+
+class MockDynamoDBClient:
+    """Applies put_item and delete_item to a dict of items. Only the
+    conditions DynamoDBDedupStore uses are supported.
+    """
+
+    class exceptions:
+        ConditionalCheckFailedException = ConditionalCheckFailedException
+
+    def __init__(self):
+        self.items = {}
+
+    def put_item(self, TableName, Item, ConditionExpression=None,
+                 ExpressionAttributeValues=None):
+        key = Item['id']['S']
+        if ConditionExpression is not None and key in self.items:
+            now = int(ExpressionAttributeValues[':now']['N'])
+            if int(self.items[key]['expires_at']['N']) >= now:
+                raise ConditionalCheckFailedException()
+        self.items[key] = Item
+
+    def delete_item(self, TableName, Key):
+        self.items.pop(Key['id']['S'], None)
+
+
+class MockStore(DedupStore):
+    def __init__(self, fail_claims=False):
+        self.claimed = set()
+        self.completed = set()
+        self.fail_claims = fail_claims
+
+    def claim(self, key):
+        if self.fail_claims:
+            raise Exception('Throttled')
+        if key in self.claimed or key in self.completed:
+            return False
+        self.claimed.add(key)
+        return True
+
+    def complete(self, key):
+        self.claimed.discard(key)
+        self.completed.add(key)
+
+    def release(self, key):
+        self.claimed.discard(key)
+
+
+class TestLRUCache(unittest.TestCase):
+    def test_add(self):
+        cache = LRUCache(2)
+        self.assertTrue(cache.add('a'))
+        self.assertFalse(cache.add('a'))
+        self.assertIn('a', cache)
+        self.assertNotIn('b', cache)
+
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(2)
+        cache.add('a')
+        cache.add('b')
+        # 'a' becomes the most recently used
+        self.assertIn('a', cache)
+        cache.add('c')
+        self.assertEqual(len(cache), 2)
+        self.assertIn('a', cache)
+        self.assertNotIn('b', cache)
+        self.assertIn('c', cache)
+
+    def test_discard(self):
+        cache = LRUCache(2)
+        cache.add('a')
+        cache.discard('a')
+        cache.discard('b')
+        self.assertNotIn('a', cache)
+        self.assertEqual(len(cache), 0)
+
+
+class TestDeduplicator(unittest.TestCase):
+    def test_claim_without_store(self):
+        dedup = Deduplicator(10)
+        self.assertTrue(dedup.claim('a'))
+        self.assertFalse(dedup.claim('a'))
+
+    def test_release(self):
+        store = MockStore()
+        dedup = Deduplicator(10, store)
+        self.assertTrue(dedup.claim('a'))
+        dedup.release('a')
+        self.assertNotIn('a', store.claimed)
+        self.assertTrue(dedup.claim('a'))
+
+    def test_claimed_by_another_container(self):
+        store = MockStore()
+        Deduplicator(10, store).claim('a')
+        dedup = Deduplicator(10, store)
+        self.assertFalse(dedup.claim('a'))
+        # Remembered, so the store isn't asked again
+        store.fail_claims = True
+        self.assertFalse(dedup.claim('a'))
+
+    def test_complete(self):
+        store = MockStore()
+        dedup = Deduplicator(10, store)
+        dedup.claim('a')
+        dedup.complete('a')
+        self.assertEqual(store.completed, set(['a']))
+        self.assertFalse(Deduplicator(10, store).claim('a'))
+
+    def test_failed_claim_raises(self):
+        dedup = Deduplicator(10, MockStore(fail_claims=True))
+        self.assertRaises(Exception, dedup.claim, 'a')
+        self.assertNotIn('a', dedup.cache)
+
+    def test_failed_release_is_logged(self):
+        store = MockStore()
+        store.release = lambda key: 1 / 0
+        dedup = Deduplicator(10, store)
+        dedup.claim('a')
+        dedup.release('a')
+        self.assertNotIn('a', dedup.cache)
+
+
+class TestDynamoDBDedupStore(unittest.TestCase):
+    def test_claim(self):
+        store = DynamoDBDedupStore(MockDynamoDBClient(), 'table', 3600, 60)
+        self.assertTrue(store.claim('a'))
+        self.assertFalse(store.claim('a'))
+        item = store.client.items['a']
+        self.assertEqual(item['status']['S'], 'in_progress')
+        self.assertAlmostEqual(int(item['expires_at']['N']),
+                               time.time() + 60, delta=5)
+
+    def test_expired_lease_is_claimable(self):
+        store = DynamoDBDedupStore(MockDynamoDBClient(), 'table', 3600, -10)
+        self.assertTrue(store.claim('a'))
+        self.assertTrue(store.claim('a'))
+
+    def test_complete(self):
+        store = DynamoDBDedupStore(MockDynamoDBClient(), 'table', 3600, -10)
+        store.claim('a')
+        store.complete('a')
+        item = store.client.items['a']
+        self.assertEqual(item['status']['S'], 'done')
+        self.assertAlmostEqual(int(item['expires_at']['N']),
+                               time.time() + 3600, delta=5)
+        self.assertFalse(store.claim('a'))
+
+    def test_release(self):
+        store = DynamoDBDedupStore(MockDynamoDBClient(), 'table', 3600, 60)
+        store.claim('a')
+        store.release('a')
+        self.assertTrue(store.claim('a'))
@@ -0,0 +1,118 @@
+import os
+import json
+import unittest
+
+import mock
+
+for name in ('ROLE_SESSION_NAME', 'CREDENTIALS_FILE_PATH', 'SPREADSHEET_ID',
+             'WORKSHEET_NAME'):
+    os.environ.setdefault(name, 'test')
+os.environ.setdefault('CONFIG_FILE_PATH', os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    'cloudtrail_monitoring_config.json'))
+
+import cloudtrail_monitoring
+from cloudtrail_dedup import Deduplicator
+from test_cloudtrail_dedup import MockStore
+
+TOPIC_ARN = 'arn:aws:sns:eu-west-1:11111:cloudtrail-logs'
+
+
+def get_event(keys):
+    """
+    :param keys: the keys of the log files.
+    :return: the SNS event of the log files' S3 notifications.
+    """
+    s3_records = [{'s3': {'bucket': {'name': 'trail'},
+                          'object': {'key': key, 'sequencer': str(i)}}}
+                  for i, key in enumerate(keys)]
+    return {'Records': [{'Sns': {
+        'TopicArn': TOPIC_ARN,
+        'Message': json.dumps({'Records': s3_records})}}]}
+
+
+def get_record(event_id):
+    """
+    :param event_id: the record's eventID.
+    :return: a CloudTrail record that matches the new_s3_bucket rule.
+    """
+    return {'eventVersion': '1.05',
+            'eventID': event_id,
+            'eventSource': 's3.amazonaws.com',
+            'eventName': 'CreateBucket',
+            'requestParameters': {'bucketName': 'bucket'},
+            'userIdentity': {'arn': 'arn:aws:iam::11111:user/someone'},
+            'recipientAccountId': '11111',
+            'awsRegion': 'eu-west-1'}
+
+
+class TestDedupRelease(unittest.TestCase):
+    def setUp(self):
+        self.store = MockStore()
+        self.dedup = Deduplicator(10, self.store)
+        patches = [
+            mock.patch('cloudtrail_monitoring.get_deduplicator',
+                       return_value=self.dedup),
+            mock.patch('cloudtrail_monitoring.prepare_s3_clients'),
+            mock.patch('cloudtrail_monitoring.get_s3_client'),
+            mock.patch('cloudtrail_monitoring.get_raw_events',
+                       side_effect=lambda s3client, key, bucket_name,
+                       rule_set: [get_record(key)]),
+            mock.patch('cloudtrail_monitoring.add_rows'),
+            mock.patch('cloudtrail_monitoring.send_notifications'),
+            mock.patch('cloudtrail_monitoring.get_archive',
+                       return_value=None)
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_completes_on_success(self):
+        self.assertTrue(cloudtrail_monitoring.main(get_event(['a', 'b']),
+                                                   None))
+        self.assertEqual(self.store.claimed, set())
+        self.assertEqual(self.store.completed, set([
+            'object:trail/a@0', 'object:trail/b@1', 'event:a', 'event:b']))
+
+    def test_releases_when_a_claim_fails(self):
+        claim = self.store.claim
+        claims = []
+
+        def claim_once(key):
+            claims.append(key)
+            if len(claims) > 1:
+                raise Exception('Throttled')
+            return claim(key)
+
+        self.store.claim = claim_once
+        self.assertRaises(Exception, cloudtrail_monitoring.main,
+                          get_event(['a', 'b']), None)
+        self.assertEqual(self.store.claimed, set())
+        self.assertNotIn('object:trail/a@0', self.dedup.cache)
+
+    def test_releases_when_clients_fail(self):
+        cloudtrail_monitoring.prepare_s3_clients.side_effect = Exception(
+            'AccessDenied')
+        self.assertRaises(Exception, cloudtrail_monitoring.main,
+                          get_event(['a']), None)
+        self.assertEqual(self.store.claimed, set())
+        self.assertEqual(self.store.completed, set())
+
+    def test_releases_when_notifying_fails(self):
+        cloudtrail_monitoring.send_notifications.side_effect = Exception(
+            'Throttled')
+        self.assertRaises(Exception, cloudtrail_monitoring.main,
+                          get_event(['a']), None)
+        self.assertEqual(self.store.claimed, set())
+        self.assertEqual(self.store.completed, set())
+
+        cloudtrail_monitoring.send_notifications.side_effect = None
+        self.assertTrue(cloudtrail_monitoring.main(get_event(['a']), None))
+        self.assertEqual(self.store.completed,
+                         set(['object:trail/a@0', 'event:a']))
+
+    def test_skips_completed_objects(self):
+        cloudtrail_monitoring.main(get_event(['a']), None)
+        cloudtrail_monitoring.get_raw_events.reset_mock()
+        cloudtrail_monitoring.main(get_event(['a']), None)
+        self.assertFalse(cloudtrail_monitoring.get_raw_events.called)
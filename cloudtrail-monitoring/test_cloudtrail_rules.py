@@ -0,0 +1,197 @@
+import json
+import unittest
+
+import cloudtrail_rules
+from cloudtrail_rules import RuleSet, parse_records
+
+CONFIG = {
+    'rules': [
+        {
+            'name': 'new_s3_bucket',
+            'source': ['s3.amazonaws.com'],
+            'event_names': ['CreateBucket'],
+            'not_includes': ['errorCode'],
+            'spreadsheet': True,
+            'sns': {'region': 'eu-west-1', 'topicARN': 'ARN'}
+        },
+        {
+            'name': 'security_group_ingress',
+            'source': ['ec2.amazonaws.com'],
+            'event_names': ['AuthorizeSecurityGroupIngress'],
+            'includes': ['0.0.0.0/0'],
+            'not_includes': ['errorCode'],
+            'sns': {'region': 'eu-west-1', 'topicARN': 'ARN'}
+        },
+        {
+            'name': 'iam',
+            'source': ['iam.amazonaws.com'],
+            'sns': {'region': 'eu-west-1', 'topicARN': 'ARN'}
+        }
+    ]
+}
+EVENTS = [
+    ('s3.amazonaws.com', 'CreateBucket'),
+    ('s3.amazonaws.com', 'GetObject'),
+    ('ec2.amazonaws.com', 'AuthorizeSecurityGroupIngress'),
+    ('ec2.amazonaws.com', 'DescribeInstances'),
+    ('iam.amazonaws.com', 'CreateUser'),
+    ('sts.amazonaws.com', 'AssumeRole'),
+]
+
+
+def get_record(i, source, event_name, cidr='0.0.0.0/0', error=False):
+    """
+    :param i: a running index, used for unique IDs.
+    :param source: the record's eventSource.
+    :param event_name: the record's eventName.
+    :param cidr: the record's CIDR range.
+    :param error: whether the record has an errorCode.
+    :return: a CloudTrail record.
+    """
+    record = {
+        'eventVersion': '1.05',
+        'userIdentity': {'arn': 'arn:aws:iam::123456789012:user/u{0}'.format(
+            i)},
+        'eventSource': source,
+        'eventName': event_name,
+        'awsRegion': 'eu-west-1',
+        'requestParameters': {
+            'bucketName': 'bucket-{0}'.format(i),
+            'ipPermissions': {'items': [{'ipRanges': {'items': [
+                {'cidrIp': cidr}]}}]}
+        },
+        'eventID': 'event-{0}'.format(i),
+        'recipientAccountId': '123456789012'
+    }
+    if error:
+        record['errorCode'] = 'AccessDenied'
+    return record
+
+
+def get_records():
+    """
+    :return: a list of records of all the EVENTS, with and without a
+        matching CIDR range and errorCode.
+    """
+    records = []
+    for source, event_name in EVENTS:
+        for cidr in ('0.0.0.0/0', '10.0.0.0/8'):
+            for error in (False, True):
+                records.append(get_record(len(records), source, event_name,
+                                          cidr, error))
+    return records
+
+
+def get_log_file(records, **kwargs):
+    """
+    :param records: the log file's records.
+    :param kwargs: passed to json.dumps.
+    :return: the decompressed bytes of a log file.
+    """
+    return json.dumps({'Records': records}, **kwargs).encode('utf-8')
+
+
+def get_matches(rule_set, records):
+    """
+    :param rule_set: a RuleSet.
+    :param records: a list of records.
+    :return: the eventIDs of the records that match one of the rules.
+    """
+    return [record['eventID'] for record in records
+            if rule_set.match(record)]
+
+
+class TestPrefilter(unittest.TestCase):
+    def assert_same_matches(self, rule_set, raw):
+        full_decode = parse_records(raw)
+        prefiltered = parse_records(raw, rule_set)
+        self.assertEqual(get_matches(rule_set, prefiltered),
+                         get_matches(rule_set, full_decode))
+        return prefiltered
+
+    def test_multiple_rules(self):
+        rule_set = RuleSet.from_config(CONFIG)
+        raw = get_log_file(get_records())
+        self.assertIsNotNone(rule_set.prefilter(raw))
+        prefiltered = self.assert_same_matches(rule_set, raw)
+        self.assertTrue(get_matches(rule_set, prefiltered))
+
+    def test_compact_separators(self):
+        rule_set = RuleSet.from_config(CONFIG)
+        raw = get_log_file(get_records(), separators=(',', ':'))
+        self.assertIsNotNone(rule_set.prefilter(raw))
+        self.assert_same_matches(rule_set, raw)
+
+    def test_skips_records_that_cant_match(self):
+        rule_set = RuleSet.from_config(CONFIG)
+        records = get_records()
+        prefiltered = rule_set.prefilter(get_log_file(records))
+        self.assertLess(len(prefiltered), len(records))
+        sources = set(record['eventSource'] for record in prefiltered)
+        self.assertNotIn('sts.amazonaws.com', sources)
+
+    def test_include_only_rule(self):
+        rule_set = RuleSet.from_config({'rules': [{
+            'name': 'access_denied',
+            'includes': ['AccessDenied'],
+            'sns': {'region': 'eu-west-1', 'topicARN': 'ARN'}
+        }]})
+        raw = get_log_file(get_records())
+        self.assertIsNotNone(rule_set.prefilter(raw))
+        prefiltered = self.assert_same_matches(rule_set, raw)
+        self.assertTrue(get_matches(rule_set, prefiltered))
+
+    def test_include_only_rule_without_literals(self):
+        # '/' may be escaped in the raw bytes, so the include isn't a literal
+        # and any record may match
+        rule_set = RuleSet.from_config({'rules': [{
+            'name': 'open_cidr',
+            'includes': ['0.0.0.0/0'],
+            'sns': {'region': 'eu-west-1', 'topicARN': 'ARN'}
+        }]})
+        raw = get_log_file(get_records())
+        self.assertIsNone(rule_set.prefilter(raw))
+        self.assert_same_matches(rule_set, raw)
+
+    def test_rule_without_literals_disables_prefilter(self):
+        config = {'rules': CONFIG['rules'] + [{
+            'name': 'everything',
+            'sns': {'region': 'eu-west-1', 'topicARN': 'ARN'}
+        }]}
+        rule_set = RuleSet.from_config(config)
+        raw = get_log_file(get_records())
+        self.assertIsNone(rule_set.prefilter(raw))
+        self.assert_same_matches(rule_set, raw)
+
+    def test_indented_file_falls_back(self):
+        rule_set = RuleSet.from_config(CONFIG)
+        raw = get_log_file(get_records(), indent=2)
+        self.assertNotIn(cloudtrail_rules.RECORD_START, raw)
+        self.assertIsNone(rule_set.prefilter(raw))
+        self.assert_same_matches(rule_set, raw)
+
+    def test_reordered_keys_fall_back(self):
+        rule_set = RuleSet.from_config(CONFIG)
+        records = [dict(record, aaa=1) for record in get_records()]
+        raw = get_log_file(records, sort_keys=True)
+        self.assertIsNone(rule_set.prefilter(raw))
+        self.assert_same_matches(rule_set, raw)
+
+    def test_legacy_config(self):
+        rule_set = RuleSet.from_config({
+            'source': ['s3.amazonaws.com'],
+            'event_names': ['CreateBucket'],
+            'sns': {'region': 'eu-west-1', 'topicARN': 'ARN'}
+        })
+        raw = get_log_file(get_records())
+        prefiltered = self.assert_same_matches(rule_set, raw)
+        self.assertEqual(len(get_matches(rule_set, prefiltered)), 4)
+
+    def test_no_rules(self):
+        rule_set = RuleSet([])
+        self.assertEqual(rule_set.prefilter(get_log_file(get_records())), [])
+
+    def test_empty_file(self):
+        rule_set = RuleSet.from_config(CONFIG)
+        raw = get_log_file([])
+        self.assertEqual(parse_records(raw, rule_set), [])
@@ -1,37 +1,434 @@
 import os
+import json
 import time
+import random
 import logging
 import datetime
 import dateutil.parser
+from multiprocessing.dummy import Lock
+from multiprocessing.dummy import Pool as ThreadPool
 
 import boto3
+import botocore.config
+from botocore.exceptions import ClientError
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
-client = boto3.client('ec2')
+
+# A JSON file of the targets, see get_targets(). Without it, the instances
+# and owners of the INSTANCE_ID and OWNER_ID env vars are the only target.
+TARGETS_FILE_PATH = os.environ.get('TARGETS_FILE_PATH')
+# Session name of the targets' assumed roles
+ROLE_SESSION_NAME = os.environ.get('ROLE_SESSION_NAME', 'daily-ami-creator')
+# Regions (of an account) processed concurrently
+REGION_WORKERS = int(os.environ.get('REGION_WORKERS', 4))
+# States of the instances that tags select
+INSTANCE_STATES = ['pending', 'running', 'stopping', 'stopped']
+# EC2 calls (create, deregister and delete) made concurrently in a region
+WORKERS = int(os.environ.get('WORKERS', 5))
+# Attempts of an EC2 call that keeps failing with RequestLimitExceeded
+MAX_ATTEMPTS = int(os.environ.get('MAX_ATTEMPTS', 8))
+# The first and the longest delay before each EC2 call while throttled
+# (seconds)
+BACKOFF_BASE = float(os.environ.get('BACKOFF_BASE', 0.5))
+BACKOFF_MAX = float(os.environ.get('BACKOFF_MAX', 20))
+# Stop starting new EC2 calls this many seconds before the Lambda times out
+TIME_MARGIN = int(os.environ.get('TIME_MARGIN', 30))
+# Where the progress is kept for the next invocation to resume from, in S3
+# or in a local file. A local file in /tmp is only seen by invocations that
+# reuse the same container, so a daily Lambda should use S3.
+CHECKPOINT_S3_BUCKET = os.environ.get('CHECKPOINT_S3_BUCKET')
+CHECKPOINT_S3_KEY = os.environ.get('CHECKPOINT_S3_KEY',
+                                   'daily_ami_creator/checkpoint.json')
+CHECKPOINT_FILE_PATH = os.environ.get(
+    'CHECKPOINT_FILE_PATH', '/tmp/daily_ami_creator_checkpoint.json')
+# Times an invocation that ran out of time invokes the function again, to
+# resume from the checkpoint on the same day
+MAX_CONTINUATIONS = int(os.environ.get('MAX_CONTINUATIONS', 10))
+
+BOTOCORE_CONFIG = botocore.config.Config(
+    max_pool_connections=max(10, WORKERS))
+client = boto3.client('ec2', config=BOTOCORE_CONFIG)
+sts_client = boto3.client('sts')
+
+
+class AdaptiveBackoff(object):
+    """Retries EC2 calls that fail with RequestLimitExceeded, and spaces out
+    the calls of all the workers while they're throttled: each throttled
+    call doubles a delay that every call waits before it starts, and each
+    successful call halves it.
+    """
+
+    def __init__(self, base=BACKOFF_BASE, maximum=BACKOFF_MAX,
+                 max_attempts=MAX_ATTEMPTS):
+        """
+        :param base: the first delay, in seconds.
+        :param maximum: the longest delay, in seconds.
+        :param max_attempts: attempts of a call before its error is raised.
+        """
+        self.base = base
+        self.maximum = maximum
+        self.max_attempts = max_attempts
+        self.delay = 0.0
+        self._lock = Lock()
+
+    def call(self, func, deadline=None, **kwargs):
+        """
+        :param func: a client method.
+        :param deadline: the time (epoch seconds) to stop waiting at. A
+            throttled call that can't be retried before it is raised.
+        :param kwargs: the method's arguments.
+        :return: the method's response.
+        """
+        for attempt in range(self.max_attempts):
+            delay = self.delay
+            if delay:
+                # Jittered, so the waiting workers don't retry together
+                delay = random.uniform(delay / 2, delay)
+                if deadline is not None:
+                    delay = max(min(delay, deadline - time.time()), 0)
+                time.sleep(delay)
+            try:
+                response = func(**kwargs)
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'RequestLimitExceeded' \
+                        or attempt == self.max_attempts - 1:
+                    raise
+                with self._lock:
+                    self.delay = min(max(self.delay * 2, self.base),
+                                     self.maximum)
+                if deadline is not None \
+                        and time.time() + self.delay / 2 > deadline:
+                    raise
+                logger.warning('Throttled, delaying calls by {0:.1f}s'.format(
+                    self.delay))
+                continue
+            with self._lock:
+                self.delay = self.delay / 2 if self.delay > self.base else 0.0
+            return response
+
+
+def run_tasks(task, items, deadline=None):
+    """Runs the task on each of the items on WORKERS threads. Items that
+    didn't start before the deadline are skipped, to be resumed by the next
+    invocation.
+
+    :param task: a function of a single item.
+    :param items: the items.
+    :param deadline: the time (epoch seconds) to stop starting tasks at.
+    :return: a dict of 'done', 'failed' and 'skipped' lists of items.
+    """
+    results = {'done': [], 'failed': [], 'skipped': []}
+    if not items:
+        return results
+
+    def run(item):
+        if deadline is not None and time.time() > deadline:
+            return item, 'skipped'
+        try:
+            task(item)
+            return item, 'done'
+        except Exception:
+            logger.exception('Failed {0} of {1}'.format(task.__name__, item))
+            return item, 'failed'
+
+    pool = ThreadPool(min(WORKERS, len(items)))
+    try:
+        for item, status in pool.imap_unordered(run, items):
+            results[status].append(item)
+    finally:
+        pool.close()
+        pool.join()
+    logger.info('{0}: {1} done, {2} failed, {3} skipped'.format(
+        task.__name__, len(results['done']), len(results['failed']),
+        len(results['skipped'])))
+    return results
+
+
+def get_deadline(context):
+    """
+    :param context: the Lambda context, may be None.
+    :return: the time (epoch seconds) to stop starting EC2 calls at, or None
+        if there's no time limit.
+    """
+    if context is None:
+        return None
+    return time.time() + context.get_remaining_time_in_millis() / 1000.0 \
+        - TIME_MARGIN
+
+
+class Checkpoint(object):
+    """The progress kept for the next invocation to resume from. For each
+    target key (see get_target_key()) it has the instances whose AMI was
+    created today, and the snapshots of deregistered AMIs that are still to
+    be deleted. Safe to update from the regions' threads.
+    """
+
+    def __init__(self, data=None):
+        """
+        :param data: the saved checkpoint's data.
+        """
+        self.data = {'date': None, 'created': {}, 'snapshots': {}}
+        if data:
+            self.data.update(data)
+        # Checkpoints of a single target kept lists
+        default_key = get_target_key(None, None)
+        for name in ('created', 'snapshots'):
+            if isinstance(self.data[name], list):
+                self.data[name] = {default_key: self.data[name]}
+        self._lock = Lock()
+
+    @classmethod
+    def load(cls):
+        """
+        :return: the Checkpoint saved by the previous invocation.
+        """
+        if CHECKPOINT_S3_BUCKET:
+            try:
+                body = boto3.client('s3').get_object(
+                    Bucket=CHECKPOINT_S3_BUCKET,
+                    Key=CHECKPOINT_S3_KEY)['Body']
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'NoSuchKey':
+                    raise
+                return cls()
+            return cls(json.loads(body.read().decode('utf-8')))
+        if os.path.exists(CHECKPOINT_FILE_PATH):
+            with open(CHECKPOINT_FILE_PATH, 'r') as f:
+                return cls(json.load(f))
+        return cls()
+
+    def start_day(self, date):
+        """Forgets the AMIs created on other days.
+
+        :param date: today's date (YYYY-MM-DD).
+        """
+        if self.data['date'] != date:
+            self.data['date'] = date
+            self.data['created'] = {}
+
+    def get_created(self, key):
+        with self._lock:
+            return set(self.data['created'].get(key, []))
+
+    def add_created(self, key, instance_ids):
+        with self._lock:
+            self.data['created'].setdefault(key, []).extend(instance_ids)
+
+    def get_snapshots(self, key):
+        with self._lock:
+            return list(self.data['snapshots'].get(key, []))
+
+    def set_snapshots(self, key, snapshot_ids):
+        with self._lock:
+            if snapshot_ids:
+                self.data['snapshots'][key] = list(snapshot_ids)
+            else:
+                self.data['snapshots'].pop(key, None)
+
+    def save(self):
+        with self._lock:
+            data = json.dumps(self.data, sort_keys=True)
+            if CHECKPOINT_S3_BUCKET:
+                boto3.client('s3').put_object(Bucket=CHECKPOINT_S3_BUCKET,
+                                              Key=CHECKPOINT_S3_KEY,
+                                              Body=data.encode('utf-8'))
+                return
+            tmp_path = CHECKPOINT_FILE_PATH + '.tmp'
+            with open(tmp_path, 'w') as f:
+                f.write(data)
+            os.rename(tmp_path, CHECKPOINT_FILE_PATH)
+
+
+def get_targets():
+    """Gets the targets from TARGETS_FILE_PATH, which looks like:
+
+        {"targets": [{"role_arn": "arn:aws:iam::111111111111:role/ami",
+                      "region": "eu-west-1",
+                      "instance_ids": ["i-0123456789abcdef0"],
+                      "tags": {"Backup": "daily"},
+                      "owners": ["111111111111"]}]}
+
+    A target without a role_arn uses the Lambda's own credentials, and one
+    without a region uses the Lambda's region. Its instances are the given
+    instance_ids and the instances that have all of its tags, where a tag's
+    value may also be a list of allowed values. Without the file, the
+    INSTANCE_ID, INSTANCE_TAGS and OWNER_ID env vars make up a single
+    target.
+
+    :return: List of targets dicts
+    """
+    if not TARGETS_FILE_PATH:
+        return [{'role_arn': None, 'region': None,
+                 'instance_ids': get_instance_ids(),
+                 'tags': get_instance_tags(),
+                 'owners': get_owner_ids()}]
+    with open(TARGETS_FILE_PATH, 'r') as f:
+        targets = json.load(f)['targets']
+    for target in targets:
+        target.setdefault('role_arn', None)
+        target.setdefault('region', None)
+        target.setdefault('instance_ids', [])
+        target.setdefault('tags', {})
+        target.setdefault('owners', [])
+    return targets
+
+
+def describe_tagged_instances(ec2, tag_keys):
+    """Lists the instances that have any of the tag keys, with a single
+    paginated and filtered describe_instances.
+
+    :param ec2: EC2 client of the account and region
+    :param tag_keys: List of tag keys
+    :return: a dict of instance ID -> dict of its tags
+    """
+    instances = {}
+    paginator = ec2.get_paginator('describe_instances')
+    for page in paginator.paginate(Filters=[
+            {'Name': 'tag-key', 'Values': sorted(tag_keys)},
+            {'Name': 'instance-state-name', 'Values': INSTANCE_STATES}]):
+        for reservation in page['Reservations']:
+            for instance in reservation['Instances']:
+                instances[instance['InstanceId']] = dict(
+                    (tag['Key'], tag['Value'])
+                    for tag in instance.get('Tags', []))
+    return instances
+
+
+def is_tags_match(instance_tags, tags):
+    """
+    :param instance_tags: a dict of the instance's tags
+    :param tags: a dict of tag key -> value or list of values
+    :return: True if the instance has all of the tags
+    """
+    for tag_key, values in tags.items():
+        if not isinstance(values, list):
+            values = [values]
+        if instance_tags.get(tag_key) not in values:
+            return False
+    return True
+
+
+def get_targets_instance_ids(ec2, targets, instances_cache):
+    """Gets the instances of the targets of a single account and region:
+    their explicit IDs, merged with the instances their tags select. The
+    tagged instances are described once per region and kept in the cache
+    for the rest of the run.
+
+    :param ec2: EC2 client of the account and region
+    :param targets: List of targets dicts
+    :param instances_cache: a dict to cache the tagged instances in
+    :return: List of instance IDs
+    """
+    instance_ids = []
+    seen = set()
+    for target in targets:
+        for instance_id in target['instance_ids']:
+            if instance_id not in seen:
+                seen.add(instance_id)
+                instance_ids.append(instance_id)
+
+    tag_keys = set()
+    for target in targets:
+        tag_keys.update(target['tags'])
+    if not tag_keys:
+        return instance_ids
+    if 'instances' not in instances_cache:
+        instances_cache['instances'] = describe_tagged_instances(ec2,
+                                                                 tag_keys)
+    instances = instances_cache['instances']
+    for target in targets:
+        if not target['tags']:
+            continue
+        for instance_id in sorted(instances):
+            if instance_id not in seen \
+                    and is_tags_match(instances[instance_id], target['tags']):
+                seen.add(instance_id)
+                instance_ids.append(instance_id)
+    return instance_ids
+
+
+def get_target_key(role_arn, region):
+    """
+    :param role_arn: the target's role ARN, or None
+    :param region: the target's region, or None
+    :return: the target's account and region, as a checkpoint key
+    """
+    account = role_arn.split(':')[4] if role_arn else 'default'
+    return '{0}/{1}'.format(account, region or 'default')
+
+
+def get_ec2_client(role_arn, region):
+    """
+    :param role_arn: a role to assume, or None for the Lambda's credentials
+    :param region: the region, or None for the Lambda's region
+    :return: EC2 client of the account and region
+    """
+    if role_arn is None and region is None:
+        return client
+    kwargs = {}
+    if role_arn:
+        cred = sts_client.assume_role(
+            RoleArn=role_arn,
+            RoleSessionName=ROLE_SESSION_NAME)['Credentials']
+        kwargs = {
+            'aws_access_key_id': cred['AccessKeyId'],
+            'aws_secret_access_key': cred['SecretAccessKey'],
+            'aws_session_token': cred['SessionToken']
+        }
+    session = boto3.session.Session(region_name=region, **kwargs)
+    return session.client('ec2', config=BOTOCORE_CONFIG)
+
+
+def get_amis(client, ami_prefix, owners):
+    """Lists the AMIs whose name starts with the prefix, filtered by name on
+    the server side.
+
+    :param client: AWS client
+    :param ami_prefix: A prefix of the ami
+    :param owners: List of owners IDs to filter, the account itself if empty
+    :return: List of AMI dicts
+    """
+    amis = []
+    paginator = client.get_paginator('describe_images')
+    for page in paginator.paginate(
+            Owners=owners or ['self'],
+            Filters=[{'Name': 'name', 'Values': [ami_prefix + '*']}]):
+        for ami in page['Images']:
+            # The filter treats wildcard characters in the prefix as such
+            if ami['Name'].startswith(ami_prefix):
+                amis.append(ami)
+    return amis
 
 
-def deregister_old_amis(client, ami_prefix, expiration, owners):
-    """Deregisters old amis that are older than the given expiration days.
+def get_expired_amis(client, ami_prefix, expiration, owners):
+    """Gets the amis that are older than the given expiration days.
 
     :param client: AWS client
     :param ami_prefix: A prefix of the ami
     :param expiration: Expiration time in seconds
     :param owners: List of owners IDs to filter
-    :return: Old amis image IDs
+    :return: Old amis dicts
     """
+    return [ami for ami in get_amis(client, ami_prefix, owners)
+            if is_ami_expired(ami, expiration)]
 
-    old_amis_ids = []
 
-    ami_list = client.describe_images(Owners=owners)
+def deregister_old_amis(client, amis, backoff, deadline=None):
+    """Deregisters the amis concurrently.
 
-    for ami in ami_list['Images']:
-        if ami['Name'].startswith(ami_prefix) \
-                and is_ami_expired(ami, expiration):
-            old_amis_ids.append(ami['ImageId'])
-            client.deregister_image(ImageId=ami['ImageId'])
+    :param client: AWS client
+    :param amis: List of AMIs dicts
+    :param backoff: AdaptiveBackoff of the EC2 calls
+    :param deadline: Time to stop starting new calls at
+    :return: The deregistered amis dicts
+    """
 
-    return old_amis_ids
+    def deregister_image(ami):
+        backoff.call(client.deregister_image, deadline,
+                     ImageId=ami['ImageId'])
+
+    return run_tasks(deregister_image, amis, deadline)['done']
 
 
 def is_ami_expired(ami, expiration):
@@ -48,38 +445,47 @@ def is_ami_expired(ami, expiration):
     return ami_creation_date - expiration_date <= datetime.timedelta(0)
 
 
-def delete_old_snapshots(client, ami_ids, owners):
-    """Deletes old snapshots given an ami id
+def delete_old_snapshots(client, snapshot_ids, backoff, deadline=None):
+    """Deletes the snapshots of deregistered AMIs concurrently
 
     :param client: AWS client
-    :param ami_id: AMI IDs list
-    :param owners: Snapshot owners IDs
+    :param snapshot_ids: Snapshot IDs list
+    :param backoff: AdaptiveBackoff of the EC2 calls
+    :param deadline: Time to stop starting new calls at
+    :return: The snapshot IDs that weren't deleted
     """
 
-    snapshots = client.describe_snapshots(OwnerIds=owners)
-    snapshot_ids = get_snapshots_ids(ami_ids, snapshots)
-
     logger.info('Deleting old snapshots: {0}'.format(snapshot_ids))
 
-    for snapshot_id in snapshot_ids:
-        client.delete_snapshot(SnapshotId=snapshot_id)
+    def delete_snapshot(snapshot_id):
+        try:
+            backoff.call(client.delete_snapshot, deadline,
+                         SnapshotId=snapshot_id)
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'InvalidSnapshot.NotFound':
+                raise
 
+    results = run_tasks(delete_snapshot, snapshot_ids, deadline)
+    return results['failed'] + results['skipped']
 
-def get_snapshots_ids(ami_ids, snapshots):
-    """Gets the snapshot IDs using the AMI ID in the description
 
-    :param snapshots: List of snapshots
-    :param ami_ids: List of AMI IDs to search
+def get_snapshots_ids(amis):
+    """Gets the snapshot IDs of the AMIs' EBS volumes from their block
+    device mappings
+
+    :param amis: List of AMIs dicts
+    :return: List of snapshot IDs
     """
 
     snapshot_ids = []
+    seen = set()
 
-    for snapshot in snapshots['Snapshots']:
-        for ami in ami_ids:
-            if ami in snapshot['Description']:
-                snapshot_ids.append(snapshot['SnapshotId'])
-                # Skip to the next snapshot
-                break
+    for ami in amis:
+        for mapping in ami.get('BlockDeviceMappings', []):
+            snapshot_id = mapping.get('Ebs', {}).get('SnapshotId')
+            if snapshot_id and snapshot_id not in seen:
+                seen.add(snapshot_id)
+                snapshot_ids.append(snapshot_id)
 
     return snapshot_ids
 
@@ -126,17 +532,154 @@ def get_instance_ids():
     return instance_ids
 
 
-def get_ami_name(ami_name_prefix):
-    """Generates the AMI name
+def get_instance_tags():
+    """Gets the tags that select instances from the INSTANCE_TAGS
+    environmental variable, e.g. Backup=daily,Env=prod
+
+    :return: a dict of tag key -> value
+    """
+    tags = {}
+    for pair in os.environ.get('INSTANCE_TAGS', '').split(','):
+        if pair.strip():
+            tag_key, _, value = pair.partition('=')
+            tags[tag_key.strip()] = value.strip()
+    return tags
+
+
+def get_ami_name(ami_name_prefix, instance_id):
+    """Generates the AMI name, unique per instance and day
+
+    :param ami_name_prefix: an AMI name prefix
+    :param instance_id: the instance ID
+    """
+    return ami_name_prefix + str(time.strftime("%Y-%m-%d")) + '-' + \
+        instance_id
+
+
+def create_images(client, instance_ids, ami_name_prefix, backoff,
+                  deadline=None):
+    """Creates today's AMIs of the instances concurrently. An instance whose
+    AMI already exists counts as done.
+
+    :param client: AWS client
+    :param instance_ids: List of instance IDs
+    :param ami_name_prefix: an AMI name prefix
+    :param backoff: AdaptiveBackoff of the EC2 calls
+    :param deadline: Time to stop starting new calls at
+    :return: a dict of 'done', 'failed' and 'skipped' instance IDs
+    """
+
+    def create_image(instance_id):
+        ami_name = get_ami_name(ami_name_prefix, instance_id)
+        logger.info('Generated ami name: ' + ami_name)
+        try:
+            backoff.call(client.create_image, deadline,
+                         InstanceId=instance_id, Name=ami_name,
+                         NoReboot=True)
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'InvalidAMIName.Duplicate':
+                raise
 
+    return run_tasks(create_image, instance_ids, deadline)
+
+
+def process_region(role_arn, region, targets, ami_name_prefix, expiration,
+                   checkpoint, instances_cache, deadline=None):
+    """Creates the AMIs of the targets of a single account and region, and
+    then cleans up the region's old AMIs and their snapshots in one batch.
+
+    :param role_arn: the targets' role ARN, or None
+    :param region: the targets' region, or None
+    :param targets: List of targets dicts
     :param ami_name_prefix: an AMI name prefix
+    :param expiration: Expiration time in seconds
+    :param checkpoint: the Checkpoint to resume from and update
+    :param instances_cache: a dict to cache the region's tagged instances in
+    :param deadline: Time to stop starting new calls at
+    :return: whether the region was fully processed
     """
-    return ami_name_prefix + str(time.strftime("%Y-%m-%d"))
+    key = get_target_key(role_arn, region)
+    ec2 = get_ec2_client(role_arn, region)
+    # Throttling is per account and region
+    backoff = AdaptiveBackoff()
+
+    # Register AMIs
+    created = checkpoint.get_created(key)
+    instance_ids = [instance_id for instance_id
+                    in get_targets_instance_ids(ec2, targets, instances_cache)
+                    if instance_id not in created]
+    results = create_images(ec2, instance_ids, ami_name_prefix, backoff,
+                            deadline)
+    checkpoint.add_created(key, results['done'])
+    checkpoint.save()
+    if results['skipped']:
+        logger.warning('{0}: out of time, {1} AMIs are left to the next '
+                       'run'.format(key, len(results['skipped'])))
+        return False
+
+    # Delete old AMIs of all the targets, listing them once. Their
+    # snapshots are kept first, so they're deleted even if this invocation
+    # stops right after deregistering.
+    owners = set()
+    for target in targets:
+        owners.update(target['owners'] or ['self'])
+    old_amis = get_expired_amis(ec2, ami_name_prefix, expiration,
+                                sorted(owners))
+    snapshot_ids = checkpoint.get_snapshots(key)
+    pending = set(snapshot_ids)
+    for snapshot_id in get_snapshots_ids(old_amis):
+        if snapshot_id not in pending:
+            pending.add(snapshot_id)
+            snapshot_ids.append(snapshot_id)
+    checkpoint.set_snapshots(key, snapshot_ids)
+    checkpoint.save()
+    deregistered = set(ami['ImageId'] for ami in deregister_old_amis(
+        ec2, old_amis, backoff, deadline))
+    # Snapshots of AMIs that are still registered can't be deleted yet, they
+    # are listed again by the next run
+    registered_snapshots = set(get_snapshots_ids(
+        [ami for ami in old_amis if ami['ImageId'] not in deregistered]))
+    snapshot_ids = [snapshot_id for snapshot_id in snapshot_ids
+                    if snapshot_id not in registered_snapshots]
+    checkpoint.set_snapshots(key, snapshot_ids)
+    checkpoint.save()
+
+    remaining = delete_old_snapshots(ec2, snapshot_ids, backoff, deadline)
+    checkpoint.set_snapshots(key, remaining)
+    checkpoint.save()
+    return len(deregistered) == len(old_amis) and not remaining
+
+
+def continue_later(event, context):
+    """Invokes the function again asynchronously, to resume from the
+    checkpoint. The continuations of a run are counted in the event, so an
+    invocation that never finishes in time doesn't invoke itself forever.
+    The function's role needs lambda:InvokeFunction on itself.
+
+    :param event: the current invocation's event.
+    :param context: the Lambda context.
+    """
+    continuation = (event or {}).get('continuation', 0) + 1
+    if continuation > MAX_CONTINUATIONS:
+        logger.error('Out of time after {0} continuations, giving up on the '
+                     "rest of today's AMIs".format(MAX_CONTINUATIONS))
+        return
+    payload = dict(event or {}, continuation=continuation)
+    boto3.client('lambda').invoke(
+        FunctionName=context.invoked_function_arn,
+        InvocationType='Event',
+        Payload=json.dumps(payload).encode('utf-8'))
+    logger.info('Out of time, invoked continuation {0}'.format(continuation))
 
 
 def main(event, context):
-    """Script to be run daily
+    """Script to be run daily. The targets' regions are processed
+    concurrently, and an invocation that runs out of time keeps its progress
+    in a checkpoint and invokes the function again to resume from it. The
+    continuation only sees the checkpoint if it's in S3
+    (CHECKPOINT_S3_BUCKET), otherwise it starts over.
 
+    Targets are read from TARGETS_FILE_PATH, see get_targets(). Without it,
     Owner IDs should be set as follows:
         OWNER_ID0 = ...
         OWNER_ID1 = ...
@@ -150,33 +693,61 @@ def main(event, context):
         .
         .
         .
+
+    And/or instances can be selected by their tags:
+        INSTANCE_TAGS = Backup=daily,...
     """
 
     # Expiration time in seconds
     expiration = int(os.environ.get('EXPIRATION'))
     ami_name_prefix = os.environ.get('AMI_PREFIX')
-    instance_ids = get_instance_ids()
-    owner_ids = get_owner_ids()
-    old_ami_ids = []
+    targets = get_targets()
+    deadline = get_deadline(context)
 
     logger.debug(
         'Init values: expiration: {0}, ami_name_prefix: {1}, '
-        'instance_ids: {2}'.format(expiration, ami_name_prefix, instance_ids))
-
-    for instance_id in instance_ids:
-        ami_name = get_ami_name(ami_name_prefix)
-
-        logger.info('Generated ami name prefix: ' + ami_name)
-
-        # Register AMI
-        client.create_image(
-            InstanceId=instance_id,
-            Name=ami_name,
-            NoReboot=True)
-
-        # Delete old AMIs
-        old_ami_ids.extend(
-            deregister_old_amis(client, ami_name_prefix, expiration,
-                                owner_ids))
-
-    delete_old_snapshots(client, old_ami_ids, owner_ids)
+        'targets: {2}'.format(expiration, ami_name_prefix, targets))
+
+    # Targets of the same account and region are processed together
+    regions = []
+    regions_targets = {}
+    for target in targets:
+        region_key = (target['role_arn'], target['region'])
+        if region_key not in regions_targets:
+            regions.append(region_key)
+            regions_targets[region_key] = []
+        regions_targets[region_key].append(target)
+
+    if not CHECKPOINT_S3_BUCKET:
+        logger.warning('CHECKPOINT_S3_BUCKET is not set, the checkpoint in '
+                       '{0} may not be seen by the next invocation'.format(
+                           CHECKPOINT_FILE_PATH))
+    checkpoint = Checkpoint.load()
+    checkpoint.start_day(time.strftime("%Y-%m-%d"))
+    # Tagged instances of each region, described once per run
+    instances_caches = dict((region_key, {}) for region_key in regions)
+
+    def process(region_key):
+        role_arn, region = region_key
+        try:
+            return process_region(role_arn, region,
+                                  regions_targets[region_key],
+                                  ami_name_prefix, expiration, checkpoint,
+                                  instances_caches[region_key], deadline)
+        except Exception:
+            logger.exception('Failed processing {0}'.format(
+                get_target_key(role_arn, region)))
+            return False
+
+    pool = ThreadPool(min(REGION_WORKERS, len(regions)) or 1)
+    try:
+        completed = pool.map(process, regions)
+    finally:
+        pool.close()
+        pool.join()
+    checkpoint.save()
+    logger.info('Processed {0} of {1} regions fully'.format(
+        sum(completed), len(regions)))
+    if not all(completed) and deadline is not None \
+            and time.time() > deadline:
+        continue_later(event, context)
@@ -1,7 +1,18 @@
+import os
+import time
+import logging
+from functools import partial
+from multiprocessing.dummy import Lock
+from multiprocessing.dummy import Queue
+from multiprocessing.dummy import Pool as ThreadPool
+
 import yaml
 
 import boto3
 
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
 REGIONS = []
 # All the account IDs
 ACCOUNTS = []
@@ -11,6 +22,133 @@ PARSER_EMAIL = 'email@domain'
 LAMBDA_ROLE_ARN = 'arn:aws:iam::' + MAIN_ACCOUNT \
                   + ':role/cloudwatch_health_event_parser'
 RESOURCES_OUTPUT_LOCATION = './resources'
+# Deployment tasks that run concurrently
+WORKERS = 10
+# Serializes the writes to the resources file
+RESOURCES_LOCK = Lock()
+# The Lambda functions' policies are updated one statement at a time, per
+# region, concurrent updates of a policy conflict
+LAMBDA_POLICY_LOCKS = dict((region, Lock()) for region in REGIONS)
+
+
+class ClientCache(object):
+    """Creates boto3 clients on first use and keeps them, keyed by account,
+    region and service. Each account has a single boto3 session.
+    """
+
+    def __init__(self, credentials):
+        """
+        :param credentials: a dict of account -> kwargs for the boto3
+            session.
+        """
+        self.credentials = credentials
+        self.sessions = {}
+        self.clients = {}
+        # Sessions aren't thread safe
+        self._lock = Lock()
+
+    def get(self, account, region, service_name):
+        """
+        :param account: the account ID.
+        :param region: the client's region.
+        :param service_name: service name to use with boto3.
+        :return: the cached client, created if needed.
+        """
+        key = (account, region, service_name)
+        client = self.clients.get(key)
+        if client is not None:
+            return client
+        with self._lock:
+            if key not in self.clients:
+                if account not in self.sessions:
+                    self.sessions[account] = boto3.session.Session(
+                        **self.credentials[account])
+                self.clients[key] = self.sessions[account].client(
+                    service_name, region_name=region)
+            return self.clients[key]
+
+
+class TaskGraph(object):
+    """Runs tasks on a bounded pool of threads as soon as the tasks they
+    depend on are done. A task that fails is logged, and the tasks that
+    depend on it are skipped, while all the others still run.
+    """
+
+    def __init__(self):
+        self.tasks = {}
+        self.order = []
+
+    def add(self, name, func, dependencies=()):
+        """Adds a task.
+
+        :param name: a unique, hashable name.
+        :param func: the task's function, called with the results of the
+            dependencies as arguments, in their order.
+        :param dependencies: names of tasks that were already added.
+        """
+        if name in self.tasks:
+            raise ValueError('Duplicate task {0}'.format(name))
+        for dependency in dependencies:
+            if dependency not in self.tasks:
+                raise ValueError('Task {0} depends on unknown task '
+                                 '{1}'.format(name, dependency))
+        self.tasks[name] = (func, tuple(dependencies))
+        self.order.append(name)
+
+    def run(self, workers=WORKERS):
+        """Runs all the tasks.
+
+        :param workers: the number of tasks that run concurrently.
+        :return: a dict of the results of the tasks that succeeded, and the
+            sets of the names of the tasks that failed and that were skipped.
+        """
+        results = {}
+        failed = set()
+        skipped = set()
+        pending = list(self.order)
+        finished = Queue()
+
+        def run_task(name):
+            func, dependencies = self.tasks[name]
+            try:
+                result = func(*[results[dependency]
+                                for dependency in dependencies])
+            except Exception:
+                logger.exception('Failed task {0}'.format(name))
+                finished.put((name, False, None))
+                return
+            finished.put((name, True, result))
+
+        pool = ThreadPool(workers)
+        running = 0
+        try:
+            while pending or running:
+                # Tasks are added after their dependencies, so a single pass
+                # propagates the skips
+                for name in list(pending):
+                    dependencies = self.tasks[name][1]
+                    if any(dependency in failed or dependency in skipped
+                           for dependency in dependencies):
+                        logger.warning('Skipping task {0}'.format(name))
+                        skipped.add(name)
+                        pending.remove(name)
+                    elif all(dependency in results
+                             for dependency in dependencies):
+                        pending.remove(name)
+                        running += 1
+                        pool.apply_async(run_task, (name,))
+                if not running:
+                    break
+                name, succeeded, result = finished.get()
+                running -= 1
+                if succeeded:
+                    results[name] = result
+                else:
+                    failed.add(name)
+        finally:
+            pool.close()
+            pool.join()
+        return results, failed, skipped
 
 
 def import_credentials(location):
@@ -20,23 +158,23 @@ def import_credentials(location):
         return yaml.load(f)
 
 
-def deploy_alarm(credentials, lambda_name, region):
+def deploy_alarm(clients, region, lambda_info):
     """Deploys an error alarm.
 
-    :param credentials: used as kwargs for the boto3 client.
-    :param lambda_name: name of the function to monitor.
+    :param clients: a ClientCache.
     :param region: region to deploy in.
+    :param lambda_info: info of the lambda to monitor.
     """
+    lambda_name = lambda_info['Name']
     alarm_name = 'cloudwatch_event_parser_errors'
-    sns_client = boto3.client('sns', region_name=region, **credentials)
+    sns_client = clients.get(MAIN_ACCOUNT, region, 'sns')
     topic_arn = sns_client.create_topic(Name='cloudwatch_alarms')['TopicArn']
     add_resource_to_resources_file('sns topic: ' + topic_arn)
     sns_client.subscribe(
         TopicArn=topic_arn,
         Protocol='email',
         Endpoint=ALARM_EMAIL)
-    cloudwatch_client = boto3.client('cloudwatch', region_name=region,
-                                     **credentials)
+    cloudwatch_client = clients.get(MAIN_ACCOUNT, region, 'cloudwatch')
     cloudwatch_client.put_metric_alarm(
         AlarmName=alarm_name,
         ActionsEnabled=True,
@@ -54,46 +192,49 @@ def deploy_alarm(credentials, lambda_name, region):
         'alarm: ' + alarm_name + ', region: ' + region)
 
 
-def handle_lambda(credentials):
-    """Handles the lambda deployments.
+def read_lambda_zip():
+    """Reads the lambda's deployment package.
+    """
+    with open('../cloudwatch-event-parser/cloudwatch_event_parser.zip',
+              'rb') as f:
+        return f.read()
+
+
+def deploy_lambda(clients, region, lambda_zip):
+    """Deploys the lambda in the main account.
 
-    :param credentials: used as kwargs for the boto3 client.
-    :returns a dict with the lambdas' info with their corresponding regions
+    :param clients: a ClientCache.
+    :param region: region to deploy in.
+    :param lambda_zip: the lambda's deployment package.
+    :return: a dict with the lambda's info
     """
-    lambdas = {}
     lambda_name = 'cloudwatch_event_parser'
     lambda_env = {'Variables': {'SOURCE': PARSER_EMAIL,
                                 'TO_ADDRESS': PARSER_EMAIL}}
-    with open('../cloudwatch-event-parser/cloudwatch_event_parser.zip',
-              'r') as f:
-        lambda_zip = f.read()
-    for region in REGIONS:
-        client = boto3.client('lambda', region_name=region, **credentials)
-        result = client.create_function(
-            FunctionName=lambda_name,
-            Runtime='python2.7',
-            Role=LAMBDA_ROLE_ARN,
-            Handler=lambda_name + '.main',
-            Code={'ZipFile': lambda_zip},
-            Description='Parses SNS notifications of health events in JSON '
-                        'format',
-            Timeout=20,
-            Environment=lambda_env)
-        lambdas[region] = {'Arn': result['FunctionArn'], 'Name': lambda_name}
-        add_resource_to_resources_file('lambda: ' + result['FunctionArn'])
-        deploy_alarm(credentials, lambda_name, region)
-
-    return lambdas
-
-
-def handle_sns_deployment(credentials, region):
+    client = clients.get(MAIN_ACCOUNT, region, 'lambda')
+    result = client.create_function(
+        FunctionName=lambda_name,
+        Runtime='python2.7',
+        Role=LAMBDA_ROLE_ARN,
+        Handler=lambda_name + '.main',
+        Code={'ZipFile': lambda_zip},
+        Description='Parses SNS notifications of health events in JSON '
+                    'format',
+        Timeout=20,
+        Environment=lambda_env)
+    add_resource_to_resources_file('lambda: ' + result['FunctionArn'])
+    return {'Arn': result['FunctionArn'], 'Name': lambda_name}
+
+
+def handle_sns_deployment(clients, account, region):
     """Deploys SNS topics.
 
-    :param credentials: used as kwargs for the boto3 client.
+    :param clients: a ClientCache.
+    :param account: account to deploy in.
     :param region: region to deploy in.
     :return: SNS ARN of the created SNS topic
     """
-    client = boto3.client('sns', region_name=region, **credentials)
+    client = clients.get(account, region, 'sns')
     topic_arn = client.create_topic(Name='cloudwatch_event_parser')['TopicArn']
     add_resource_to_resources_file('sns topic: ' + topic_arn)
     client.add_permission(
@@ -104,16 +245,17 @@ def handle_sns_deployment(credentials, region):
     return topic_arn
 
 
-def deploy_event_rule(credentials, region, target_sns_arn):
+def deploy_event_rule(clients, account, region, target_sns_arn):
     """Deploys a health event rule.
 
-    :param credentials: used as kwargs for the boto3 client.
+    :param clients: a ClientCache.
+    :param account: account to deploy in.
     :param region: region to deploy in.
     :param target_sns_arn: SNS ARN to add as a target for the rule.
     """
     rule_name = 'cloudwatch_health_event_parser'
     pattern = '{"source": ["aws.health"]}'
-    client = boto3.client('events', region_name=region, **credentials)
+    client = clients.get(account, region, 'events')
     rule_arn = client.put_rule(
         Name=rule_name,
         EventPattern=pattern,
@@ -128,45 +270,63 @@ def deploy_event_rule(credentials, region, target_sns_arn):
             'Arn': target_sns_arn}])
 
 
-def handle_asset_deployments(credentials):
-    """Handles all the other assets' deployment.
+def establish_lambda_sns_relationship(clients, account, region, lambda_info,
+                                      sns_arn):
+    """Adds invoke permissions for an account's SNS to the lambda of its
+    region, and subscribes the lambda to it.
 
-    :param credentials: used as kwargs for the boto3 client.
-    :return: a dict of all the created sns arns with the regions as keys.
+    :param clients: a ClientCache.
+    :param account: the SNS's account.
+    :param region: the region of the SNS and the lambda.
+    :param lambda_info: the lambda's info.
+    :param sns_arn: the SNS ARN.
     """
-    sns_arns = {}
-    for region in REGIONS:
-        sns_arns[region] = handle_sns_deployment(
-            credentials,
-            region)
-        deploy_event_rule(credentials, region, sns_arns[region])
-    return sns_arns
+    lambda_client = clients.get(MAIN_ACCOUNT, region, 'lambda')
+    with LAMBDA_POLICY_LOCKS[region]:
+        lambda_client.add_permission(
+            FunctionName=lambda_info['Name'],
+            StatementId=lambda_info['Name'] + '_' + account + '_' + region +
+            '_' + str(time.time()).replace('.', '-'),
+            Action='lambda:InvokeFunction',
+            Principal='sns.amazonaws.com',
+            SourceArn=sns_arn)
+
+    sns_client = clients.get(MAIN_ACCOUNT, region, 'sns')
+    sns_client.subscribe(
+        TopicArn=sns_arn,
+        Protocol='lambda',
+        Endpoint=lambda_info['Arn'])
 
 
-def establish_lambda_sns_relationship(credentials, lambdas, sns_arns):
-    """Adds invoke permissions for each SNS to each lambdas with respect to a
-    region.
+def build_deployment(clients, lambda_zip):
+    """Builds the deployment's tasks: the lambda and its alarm in each region
+    of the main account, and in each account and region the SNS, the event
+    rule and the lambda's permissions and subscription.
 
-    :param credentials: used as kwargs for the boto3 client.
-    :param lambdas: a dict of lambda functions with regions as keys.
-    :param sns_arns: a dict of all the sns arns with the regions as keys.
+    :param clients: a ClientCache.
+    :param lambda_zip: the lambda's deployment package.
+    :return: a TaskGraph.
     """
+    graph = TaskGraph()
     for region in REGIONS:
-        lambda_client = boto3.client('lambda', region_name=region,
-                                     **credentials)
-        lambda_client.add_permission(
-            FunctionName=lambdas[region]['Name'],
-            StatementId=lambdas[region]['Name'] + '_' + region + '_' + str(
-                time.time()).replace('.', '-'),
-            Action='lambda:InvokeFunction',
-            Principal='sns.amazonaws.com',
-            SourceArn=sns_arns[region])
-
-        sns_client = boto3.client('sns', region_name=region, **credentials)
-        sns_client.subscribe(
-            TopicArn=sns_arns[region],
-            Protocol='lambda',
-            Endpoint=lambdas[region]['Arn'])
+        graph.add(('lambda', region),
+                  partial(deploy_lambda, clients, region, lambda_zip))
+        graph.add(('alarm', region),
+                  partial(deploy_alarm, clients, region),
+                  [('lambda', region)])
+    for account in ACCOUNTS:
+        for region in REGIONS:
+            graph.add(('sns', account, region),
+                      partial(handle_sns_deployment, clients, account,
+                              region))
+            graph.add(('rule', account, region),
+                      partial(deploy_event_rule, clients, account, region),
+                      [('sns', account, region)])
+            graph.add(('permissions', account, region),
+                      partial(establish_lambda_sns_relationship, clients,
+                              account, region),
+                      [('lambda', region), ('sns', account, region)])
+    return graph
 
 
 def add_resource_to_resources_file(resource):
@@ -174,8 +334,9 @@ def add_resource_to_resources_file(resource):
 
     :param resource: resource arn.
     """
-    with open(RESOURCES_OUTPUT_LOCATION, 'a') as f:
-        f.write(resource + '\n')
+    with RESOURCES_LOCK:
+        with open(RESOURCES_OUTPUT_LOCATION, 'a') as f:
+            f.write(resource + '\n')
 
 
 def reset_resources():
@@ -188,13 +349,16 @@ def reset_resources():
 
 
 def main():
+    logging.basicConfig()
     reset_resources()
     all_creds = import_credentials('')
-    lambdas = handle_lambda(all_creds[MAIN_ACCOUNT])
-    for account in ACCOUNTS:
-        sns_arns = handle_asset_deployments(all_creds[account])
-        establish_lambda_sns_relationship(all_creds[MAIN_ACCOUNT], lambdas,
-                                          sns_arns)
+    clients = ClientCache(all_creds)
+    graph = build_deployment(clients, read_lambda_zip())
+    results, failed, skipped = graph.run(WORKERS)
+    logger.info('Deployed {0} of {1} tasks, {2} failed, {3} skipped'.format(
+        len(results), len(graph.order), len(failed), len(skipped)))
+    if failed or skipped:
+        raise SystemExit(1)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,180 @@
+"""Benchmarks s3_database_validator.validate_data() over synthetic
+spreadsheets, against the fake backends of validator_local, e.g.:
+
+    python benchmark_validator.py --rows 1000 10000 50000 \
+        --aws-latency 0.02 --sheets-latency 0.2 --throttle-rate 0.01
+
+Each size runs in its own process, so its peak RSS is its own. Reports the
+wall time, the API calls by type and the peak memory, and fails if a cell
+other than a weight or region was rewritten or changed its type.
+"""
+import os
+import sys
+import time
+import random
+import logging
+import argparse
+import resource
+from multiprocessing import Process
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+HEADERS = ['Bucket Name', 'Created By', 'Created At', 'Weight (MB)',
+           'Account', 'Region']
+
+
+def set_environment():
+    """Sets the env vars s3_database_validator requires at import.
+    """
+    for name in ('ROLE_SESSION_NAME', 'CREDENTIALS_FILE_PATH',
+                 'SPREADSHEET_ID', 'WORKSHEET_NAME'):
+        os.environ.setdefault(name, 'benchmark')
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    os.environ.pop('SNAPSHOT_S3_BUCKET', None)
+    os.environ.pop('SNAPSHOT_FILE_PATH', None)
+
+
+def generate_data(rows, accounts, regions, missing_fraction, stale_fraction,
+                  duplicate_fraction, seed):
+    """Generates a spreadsheet and the buckets it describes.
+
+    :param rows: the number of rows, besides the headers.
+    :param accounts: the account numbers.
+    :param regions: the regions of the buckets.
+    :param missing_fraction: the fraction of rows whose bucket doesn't exist.
+    :param stale_fraction: the fraction of rows with an outdated weight.
+    :param duplicate_fraction: the fraction of rows that are duplicates.
+    :param seed: a seed for the data.
+    :return: a dict of account number -> bucket name -> (region, size), and
+        the spreadsheet's rows.
+    """
+    rnd = random.Random(seed)
+    buckets = dict((account, {}) for account in accounts)
+    sheet_rows = [list(HEADERS)]
+    i = 0
+    while len(sheet_rows) <= rows:
+        account = accounts[i % len(accounts)]
+        name = 'benchmark-bucket-{0:07d}'.format(i)
+        region = rnd.choice(regions)
+        size = rnd.randint(0, 10 ** 11)
+        if rnd.random() >= missing_fraction:
+            buckets[account][name] = (region, size)
+        weight = round(size / 1000000.0, 2)
+        if rnd.random() < stale_fraction:
+            weight = ''
+        row = [name, 'benchmark', '2018-01-01', weight, account, region]
+        sheet_rows.append(row)
+        if len(sheet_rows) <= rows and rnd.random() < duplicate_fraction:
+            sheet_rows.append(list(row))
+        i += 1
+    return buckets, sheet_rows
+
+
+def get_untouched_cells(rows, columns):
+    """
+    :param rows: the spreadsheet's rows.
+    :param columns: the indexes of the columns the validator doesn't write.
+    :return: a set of the rows' cells in those columns, with their types.
+    """
+    return set(tuple((type(row[i]), row[i]) for i in columns)
+               for row in rows)
+
+
+def run(rows, args):
+    """Runs validate_data() once over a synthetic spreadsheet and prints the
+    results.
+
+    :param rows: the number of rows.
+    :param args: the parsed command line arguments.
+    """
+    set_environment()
+    import s3_database_validator as validator
+    from validator_local import (CallCounter, FakeClientCache, FakeWorld,
+                                 FakeWorksheet)
+
+    # With leading zeros, which must stay strings
+    accounts = ['{0:012d}'.format(i + 1) for i in range(args.accounts)]
+    buckets, sheet_rows = generate_data(
+        rows, accounts, validator.REGIONS, args.missing_fraction,
+        args.stale_fraction, args.duplicate_fraction, args.seed)
+    counter = CallCounter()
+    world = FakeWorld(buckets, counter, args.aws_latency, args.throttle_rate,
+                      args.seed)
+    untouched_columns = [i for i in range(len(HEADERS)) if i not in (
+        validator.COLUMNS['WEIGHT'], validator.COLUMNS['REGION'])]
+    untouched = get_untouched_cells(sheet_rows, untouched_columns)
+    sheet = FakeWorksheet(sheet_rows, counter, args.sheets_latency)
+    validator.get_worksheet = lambda: sheet
+    validator.ClientCache = lambda credentials: FakeClientCache(world)
+    validator.BUCKET_REGIONS.clear()
+    # The validator sets the root logger's level when it's imported
+    logging.getLogger().setLevel(
+        logging.INFO if args.verbose else logging.WARNING)
+    credentials = dict((account, {}) for account in accounts)
+
+    if args.trace_memory and tracemalloc:
+        tracemalloc.start()
+    start = time.time()
+    validator.validate_data(credentials)
+    elapsed = time.time() - start
+
+    print('Rows: {0} -> {1}, accounts: {2}'.format(
+        rows, len(sheet.rows) - 1, len(accounts)))
+    print('Elapsed: {0:.2f}s, {1:.0f} rows/sec'.format(
+        elapsed, rows / elapsed))
+    for name in sorted(counter.counts):
+        print('  {0:>36}: {1}'.format(name, counter.counts[name]))
+    # ru_maxrss is in kilobytes on Linux
+    print('Peak RSS: {0:.1f} MB'.format(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0))
+    if args.trace_memory and tracemalloc:
+        print('Peak Python heap: {0:.1f} MB'.format(
+            tracemalloc.get_traced_memory()[1] / 1048576.0))
+    sys.stdout.flush()
+    if not get_untouched_cells(sheet.rows, untouched_columns) <= untouched:
+        sys.exit('Cells other than weights and regions were rewritten')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmarks s3_database_validator.validate_data() '
+                    'against fake backends.')
+    parser.add_argument('--rows', type=int, nargs='+',
+                        default=[1000, 10000, 50000],
+                        help='spreadsheet sizes to benchmark')
+    parser.add_argument('--accounts', type=int, default=5)
+    parser.add_argument('--aws-latency', type=float, default=0.02,
+                        help='seconds each S3 and CloudWatch call takes')
+    parser.add_argument('--sheets-latency', type=float, default=0.2,
+                        help='seconds each spreadsheet call takes')
+    parser.add_argument('--throttle-rate', type=float, default=0.0,
+                        help='the probability of an AWS call being '
+                             'throttled')
+    parser.add_argument('--missing-fraction', type=float, default=0.05,
+                        help="the fraction of rows whose bucket doesn't "
+                             "exist")
+    parser.add_argument('--stale-fraction', type=float, default=0.3,
+                        help='the fraction of rows with an outdated weight')
+    parser.add_argument('--duplicate-fraction', type=float, default=0.02)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--trace-memory', action='store_true',
+                        help='also report the peak Python heap, slower')
+    parser.add_argument('--verbose', action='store_true',
+                        help="show the validator's logs")
+    args = parser.parse_args()
+    logging.basicConfig()
+
+    for rows in args.rows:
+        process = Process(target=run, args=(rows, args))
+        process.start()
+        process.join()
+        if process.exitcode:
+            sys.exit(process.exitcode)
+        print('')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,15 @@
 import os
+import json
+import time
+import hashlib
 import logging
+import calendar
 from datetime import datetime, timedelta
-from multiprocessing.dummy import Process, Lock
+from multiprocessing.dummy import Lock
 from multiprocessing.dummy import Pool as ThreadPool
 
 import boto3
+from botocore.exceptions import ClientError
 import gspread
 from oauth2client.service_account import ServiceAccountCredentials
 
@@ -47,6 +52,48 @@ REGIONS = [
     'ap-northeast-1',
     'sa-east-1'
 ]
+# Rows validated, and metric requests sent, concurrently
+VALIDATION_WORKERS = int(os.environ.get('VALIDATION_WORKERS', 10))
+# S3 publishes the storage metrics once a day
+METRIC_PERIOD = 86400
+# Incremental mode: where to keep the snapshot of the checked buckets, in S3
+# or in a local file. Without either every row is checked on every run.
+SNAPSHOT_S3_BUCKET = os.environ.get('SNAPSHOT_S3_BUCKET')
+SNAPSHOT_S3_KEY = os.environ.get('SNAPSHOT_S3_KEY',
+                                 's3_database_validator/snapshot.json')
+SNAPSHOT_FILE_PATH = os.environ.get('SNAPSHOT_FILE_PATH')
+# Incremental mode: the most buckets to fetch sizes for in a run, new and
+# edited rows first and then the least recently checked, 0 for no limit
+MAX_CHECKED_BUCKETS = int(os.environ.get('MAX_CHECKED_BUCKETS', 0))
+# Storage types summed up for the bucket size, every StorageType of the
+# BucketSizeBytes metric of general purpose buckets, including the overheads
+# that are billed along with the objects
+STORAGE_TYPES = [
+    'StandardStorage',
+    'IntelligentTieringFAStorage',
+    'IntelligentTieringIAStorage',
+    'IntelligentTieringAAStorage',
+    'IntelligentTieringAIAStorage',
+    'IntelligentTieringDAAStorage',
+    'StandardIAStorage',
+    'StandardIASizeOverhead',
+    'StandardIAObjectOverhead',
+    'OneZoneIAStorage',
+    'OneZoneIASizeOverhead',
+    'ReducedRedundancyStorage',
+    'GlacierInstantRetrievalStorage',
+    'GlacierInstantRetrievalSizeOverhead',
+    'GlacierStorage',
+    'GlacierStagingStorage',
+    'GlacierObjectOverhead',
+    'GlacierS3ObjectOverhead',
+    'DeepArchiveStorage',
+    'DeepArchiveObjectOverhead',
+    'DeepArchiveS3ObjectOverhead',
+    'DeepArchiveStagingStorage'
+]
+# GetMetricData takes up to 500 queries, one per bucket and storage type
+BUCKETS_PER_METRIC_REQUEST = 500 // len(STORAGE_TYPES)
 COLUMNS = {
     'BUCKET_NAME': 0,
     'CREATED_BY': 1,
@@ -63,39 +110,306 @@ ROLE_ARNS = {
     '11111111': {'RoleArn': os.getenv(
         ACCOUNTS_NUMBER_TO_NAME['111111'] + '_RoleArn')}
 }
-BUCKET_LIST = {
-    '111111': set()
+# (bucket name, account number) -> region, kept across warm invocations
+BUCKET_REGIONS = {
 }
 
 
-def get_bucket_size(bucket_name, client, byte_conv_fun=lambda x: x):
-    """Returns the bucket size.
+def get_metric_data_sizes(bucket_names, client):
+    """Returns the sizes of the given buckets with a single GetMetricData
+    sweep over all of their storage types (paginated if needed).
 
-    :param bucket_name: bucket name to get it's size
-    :param client: cloudwatch client.
-    :param byte_conv_fun: a byte conversion function.
+    :param bucket_names: up to BUCKETS_PER_METRIC_REQUEST bucket names.
+    :param client: cloudwatch client of the buckets' region.
+    :return: a dict of bucket name -> (size in bytes, summed over the
+        storage types, timestamp of the latest datapoint in epoch seconds),
+        for the buckets that have datapoints.
     """
-    response = client.get_metric_statistics(
-        Namespace="AWS/S3",
-        MetricName="BucketSizeBytes",
-        Dimensions=[
-            {
-                "Name": "BucketName",
-                "Value": bucket_name
-            },
-            {
-                "Name": "StorageType",
-                "Value": "StandardStorage"
-            }
-        ],
-        StartTime=datetime.utcnow() - timedelta(days=2),
-        EndTime=datetime.utcnow(),
-        Period=86400,
-        Statistics=['Average']
-    )
-    if not response['Datapoints']:
-        return -1
-    return byte_conv_fun(int(response['Datapoints'][-1]['Average']))
+    queries = []
+    query_buckets = {}
+    for i, bucket_name in enumerate(bucket_names):
+        for j, storage_type in enumerate(STORAGE_TYPES):
+            query_id = 'b{0}_{1}'.format(i, j)
+            query_buckets[query_id] = bucket_name
+            queries.append({
+                'Id': query_id,
+                'MetricStat': {
+                    'Metric': {
+                        'Namespace': 'AWS/S3',
+                        'MetricName': 'BucketSizeBytes',
+                        'Dimensions': [
+                            {
+                                'Name': 'BucketName',
+                                'Value': bucket_name
+                            },
+                            {
+                                'Name': 'StorageType',
+                                'Value': storage_type
+                            }
+                        ]
+                    },
+                    'Period': METRIC_PERIOD,
+                    'Stat': 'Average'
+                },
+                'ReturnData': True
+            })
+
+    sizes = {}
+    kwargs = {
+        'MetricDataQueries': queries,
+        'StartTime': datetime.utcnow() - timedelta(days=2),
+        'EndTime': datetime.utcnow(),
+        'ScanBy': 'TimestampDescending'
+    }
+    seen = set()
+    while True:
+        response = client.get_metric_data(**kwargs)
+        for result in response['MetricDataResults']:
+            # Only the latest value of each query, which comes first
+            if result['Values'] and result['Id'] not in seen:
+                seen.add(result['Id'])
+                bucket_name = query_buckets[result['Id']]
+                size, timestamp = sizes.get(bucket_name, (0, 0))
+                sizes[bucket_name] = (
+                    size + int(result['Values'][0]),
+                    max(timestamp, calendar.timegm(
+                        result['Timestamps'][0].utctimetuple())))
+        if not response.get('NextToken'):
+            return sizes
+        kwargs['NextToken'] = response['NextToken']
+
+
+def query_bucket_sizes(buckets_by_region, clients):
+    """Queries the sizes of the buckets in the given regions, batching up to
+    BUCKETS_PER_METRIC_REQUEST buckets per request, with the requests running
+    concurrently.
+
+    :param buckets_by_region: a dict of (account number, region) -> bucket
+        names to look for in that region.
+    :param clients: a ClientCache.
+    :return: a dict of (bucket name, account number) -> (size in bytes,
+        metric timestamp, region) for the buckets that have datapoints, or
+        None for the buckets whose request failed.
+    """
+    batches = []
+    for (account, region), bucket_names in buckets_by_region.items():
+        for i in range(0, len(bucket_names), BUCKETS_PER_METRIC_REQUEST):
+            batches.append((account, region,
+                            bucket_names[i:i + BUCKETS_PER_METRIC_REQUEST]))
+    if not batches:
+        return {}
+
+    def query(batch):
+        account, region, bucket_names = batch
+        try:
+            return batch, get_metric_data_sizes(
+                bucket_names, clients.get('cloudwatch', account, region))
+        except Exception:
+            logger.exception('Failed getting the sizes of {0} buckets of '
+                             'account {1} in {2}'.format(len(bucket_names),
+                                                         account, region))
+            return batch, None
+
+    sizes = {}
+    pool = ThreadPool(min(VALIDATION_WORKERS, len(batches)))
+    try:
+        for (account, region, bucket_names), batch_sizes in pool.imap(
+                query, batches):
+            for bucket_name in bucket_names:
+                if batch_sizes is None:
+                    sizes[(bucket_name, account)] = None
+                elif bucket_name in batch_sizes:
+                    sizes[(bucket_name, account)] = \
+                        batch_sizes[bucket_name] + (region,)
+    finally:
+        pool.close()
+        pool.join()
+    return sizes
+
+
+def get_bucket_sizes(buckets, clients):
+    """Returns the sizes of the buckets. Each bucket is looked up in its
+    region, buckets whose region is unknown are looked up in all the regions
+    at once.
+
+    :param buckets: a list of (bucket name, account number, region) tuples,
+        the region may be None.
+    :param clients: a ClientCache.
+    :return: a dict of (bucket name, account number) -> (size in bytes,
+        metric timestamp, region). Buckets without datapoints are missing,
+        and buckets whose request failed are None.
+    """
+    buckets_by_region = {}
+    for bucket_name, account, region in buckets:
+        for bucket_region in [region] if region else REGIONS:
+            buckets_by_region.setdefault((account, bucket_region), []).append(
+                bucket_name)
+    return query_bucket_sizes(buckets_by_region, clients)
+
+
+def get_bucket_region(bucket_name, client):
+    """Returns the region of the bucket from its location, or from the region
+    header of a HEAD request if the location can't be read.
+
+    :param bucket_name: bucket name to get it's region.
+    :param client: s3 client of the bucket's account.
+    :return: the region name.
+    """
+    try:
+        location = client.get_bucket_location(
+            Bucket=bucket_name)['LocationConstraint']
+    except ClientError:
+        try:
+            response = client.head_bucket(Bucket=bucket_name)
+        except ClientError as e:
+            response = e.response
+        return response['ResponseMetadata']['HTTPHeaders'][
+            'x-amz-bucket-region']
+    if not location:
+        return 'us-east-1'
+    if location == 'EU':
+        return 'eu-west-1'
+    return location
+
+
+def resolve_bucket_regions(buckets, clients):
+    """Resolves the regions of the buckets concurrently. Resolved regions are
+    cached in BUCKET_REGIONS, so each bucket is only resolved once.
+
+    :param buckets: a list of (bucket name, account number) tuples.
+    :param clients: a ClientCache.
+    :return: a dict of (bucket name, account number) -> region, None for the
+        buckets that couldn't be resolved.
+    """
+    unresolved = [bucket for bucket in set(buckets)
+                  if bucket not in BUCKET_REGIONS]
+
+    def resolve(bucket):
+        bucket_name, account = bucket
+        try:
+            return bucket, get_bucket_region(bucket_name,
+                                             clients.get('s3', account))
+        except Exception:
+            logger.exception('Failed resolving the region of {0} of account '
+                             '{1}'.format(bucket_name, account))
+            return bucket, None
+
+    if unresolved:
+        logger.info('Resolving the regions of {0} buckets...'.format(
+            len(unresolved)))
+        pool = ThreadPool(min(VALIDATION_WORKERS, len(unresolved)))
+        try:
+            for bucket, region in pool.imap_unordered(resolve, unresolved):
+                if region:
+                    BUCKET_REGIONS[bucket] = region
+        finally:
+            pool.close()
+            pool.join()
+    return dict((bucket, BUCKET_REGIONS.get(bucket)) for bucket in buckets)
+
+
+def get_snapshot_key(bucket_name, account_num):
+    return '{0}/{1}'.format(account_num, bucket_name)
+
+
+def get_row_hash(row):
+    """
+    :param row: a spreadsheet row.
+    :return: a hash of the row's columns that are filled in by people, so an
+        edited row is checked again.
+    """
+    owned = [row[COLUMNS[column]] for column in
+             ('BUCKET_NAME', 'CREATED_BY', 'CREATED_AT', 'ACCOUNT')]
+    return hashlib.md5(json.dumps(owned).encode('utf-8')).hexdigest()
+
+
+def is_row_unchanged(row, entry):
+    """
+    :param row: a spreadsheet row.
+    :param entry: the row's bucket's snapshot entry.
+    :return: whether the row is as it was when it was checked, i.e. it wasn't
+        edited and has the weight and region that were found.
+    """
+    if entry['row_hash'] != get_row_hash(row) \
+            or entry['region'] != row[COLUMNS['REGION']]:
+        return False
+    weight = -1 if entry['size'] is None \
+        else round(entry['size'] / 1000000.0, 2)
+    try:
+        # The sheet may show the weight formatted differently
+        return float(row[COLUMNS['WEIGHT']]) == weight
+    except ValueError:
+        return False
+
+
+def load_snapshot():
+    """
+    :return: the snapshot of the buckets checked by the previous runs, a dict
+        of get_snapshot_key() -> {'region', 'size', 'timestamp',
+        'checked_at', 'row_hash'}, or None if incremental mode is off.
+    """
+    if SNAPSHOT_S3_BUCKET:
+        try:
+            body = boto3.client('s3').get_object(
+                Bucket=SNAPSHOT_S3_BUCKET, Key=SNAPSHOT_S3_KEY)['Body']
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'NoSuchKey':
+                raise
+            return {}
+        return json.loads(body.read().decode('utf-8'))['buckets']
+    if SNAPSHOT_FILE_PATH:
+        if not os.path.exists(SNAPSHOT_FILE_PATH):
+            return {}
+        with open(SNAPSHOT_FILE_PATH, 'r') as f:
+            return json.load(f)['buckets']
+    return None
+
+
+def save_snapshot(snapshot):
+    """
+    :param snapshot: the snapshot to keep for the next run.
+    """
+    data = json.dumps({'buckets': snapshot}, sort_keys=True)
+    if SNAPSHOT_S3_BUCKET:
+        boto3.client('s3').put_object(Bucket=SNAPSHOT_S3_BUCKET,
+                                      Key=SNAPSHOT_S3_KEY,
+                                      Body=data.encode('utf-8'))
+    elif SNAPSHOT_FILE_PATH:
+        tmp_path = SNAPSHOT_FILE_PATH + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(data)
+        os.rename(tmp_path, SNAPSHOT_FILE_PATH)
+
+
+def select_rows(existing, snapshot, now):
+    """Selects the rows whose size should be fetched in this run. Rows that
+    are new or were edited since they were checked come first, and are
+    always selected. Rows whose latest datapoint is less than a metric
+    period old can't have a newer one yet and are skipped, and the rest are
+    selected from the least recently checked, up to MAX_CHECKED_BUCKETS.
+
+    :param existing: a list of (index, row) of the rows to check.
+    :param snapshot: the snapshot from load_snapshot().
+    :param now: the current time in epoch seconds.
+    :return: the list of (index, row) to check.
+    """
+    changed = []
+    stale = []
+    for index, row in existing:
+        entry = snapshot.get(get_snapshot_key(row[COLUMNS['BUCKET_NAME']],
+                                              row[COLUMNS['ACCOUNT']]))
+        if entry is None or not is_row_unchanged(row, entry):
+            changed.append((index, row))
+        elif not entry['timestamp'] \
+                or now >= entry['timestamp'] + METRIC_PERIOD:
+            stale.append((entry['checked_at'], index, row))
+    stale.sort(key=lambda item: item[:2])
+    if MAX_CHECKED_BUCKETS:
+        stale = stale[:max(0, MAX_CHECKED_BUCKETS - len(changed))]
+    logger.info('Checking {0} new or edited rows and {1} of {2} unchanged '
+                'rows'.format(len(changed), len(stale),
+                              len(existing) - len(changed)))
+    return changed + [(index, row) for _, index, row in stale]
 
 
 def get_credentials_dict(sts_client):
@@ -123,90 +437,215 @@ def get_credentials_dict(sts_client):
     return cred_dict
 
 
-def is_exist(bucket_name, client, account_number):
-    """Returns whether the bucket exists.
-
-    :param bucket_name: bucket name to check.
-    :param client: s3 client to use.
-    :param account_number: account number to save it's S3 buckets.
+def list_bucket_names(client):
+    """
+    :param client: s3 client of the account.
+    :return: a frozenset of the names of the account's buckets.
     """
-    if not BUCKET_LIST[account_number]:
-        for bucket in client.list_buckets()['Buckets']:
-            BUCKET_LIST[account_number].add(bucket['Name'])
-    return bucket_name in BUCKET_LIST[account_number]
+    names = set()
+    kwargs = {}
+    while True:
+        response = client.list_buckets(**kwargs)
+        for bucket in response['Buckets']:
+            names.add(bucket['Name'])
+        if not response.get('ContinuationToken'):
+            return frozenset(names)
+        kwargs['ContinuationToken'] = response['ContinuationToken']
+
+
+def get_bucket_inventories(accounts, clients):
+    """Lists the buckets of all the accounts concurrently, once per account.
+    Raises if any of the listings fails, since a partial inventory would mark
+    existing buckets for deletion.
+
+    :param accounts: the account numbers.
+    :param clients: a ClientCache.
+    :return: a dict of account number -> frozenset of bucket names.
+    """
+    def list_account(account_num):
+        return account_num, list_bucket_names(clients.get('s3', account_num))
 
+    logger.info('Listing the buckets of {0} accounts...'.format(
+        len(accounts)))
+    pool = ThreadPool(min(VALIDATION_WORKERS, len(accounts)) or 1)
+    try:
+        return dict(pool.map(list_account, accounts))
+    finally:
+        pool.close()
+        pool.join()
 
-def execute_updates(contents, sheet):
-    """Executes the relevant updates, modify first and delete after.
 
-    :param contents: contents containing the changings.
-    :param sheet: Google Spreadsheet client.
+def is_exist(bucket_name, inventories, account_number):
+    """Returns whether the bucket exists.
+
+    :param bucket_name: bucket name to check.
+    :param inventories: a dict of account number -> bucket names, from
+        get_bucket_inventories.
+    :param account_number: the bucket's account number.
     """
+    return bucket_name in inventories[account_number]
 
-    def handle_update_value(item):
-        if 'weight' in item and 'region' in item and 'index' in item:
-            sheet.update_cell(
-                item['index'] + 1,
-                COLUMNS['WEIGHT'] + 1,
-                item['weight'])
-            sheet.update_cell(
-                item['index'] + 1,
-                COLUMNS['REGION'] + 1,
-                item['region'])
 
-    pool = ThreadPool()
-    logger.info('Executing value updates...')
-    # Main headers are also in contents
-    pool.map(handle_update_value, contents[1:])
+def get_cells_update_request(sheet_id, row_index, column_index, values):
+    """
+    :param sheet_id: the worksheet's ID.
+    :param row_index: zero based index of the first row.
+    :param column_index: zero based column index.
+    :param values: the cells' new values, from the first row down.
+    :return: a batchUpdate request that sets consecutive cells of a column.
+    """
+    rows = []
+    for value in values:
+        if isinstance(value, (int, float)):
+            cell_value = {'numberValue': value}
+        else:
+            cell_value = {'stringValue': value}
+        rows.append({'values': [{'userEnteredValue': cell_value}]})
+    return {
+        'updateCells': {
+            'start': {
+                'sheetId': sheet_id,
+                'rowIndex': row_index,
+                'columnIndex': column_index
+            },
+            'rows': rows,
+            'fields': 'userEnteredValue'
+        }
+    }
 
-    logger.info('Executing deletions...')
-    for i in range(len(contents) - 1, 0, -1):
-        if 'delete' in contents[i]:
-            sheet.delete_row(i + 1)
 
+def get_delete_rows_request(sheet_id, start_index, end_index):
+    """
+    :param sheet_id: the worksheet's ID.
+    :param start_index: zero based index of the first row to delete.
+    :param end_index: zero based index after the last row to delete.
+    :return: a batchUpdate request that deletes the rows.
+    """
+    return {
+        'deleteDimension': {
+            'range': {
+                'sheetId': sheet_id,
+                'dimension': 'ROWS',
+                'startIndex': start_index,
+                'endIndex': end_index
+            }
+        }
+    }
 
-def get_clients(service_name, credentials, region_name='us-east-1'):
-    """Returns a dict of service_name clients, keys are the account number, for
-    a single region.
 
-    :param service_name: service name to use with boto3
-    :param credentials: credentials dict.
-    :param region_name: region to instantiate the clients for.
-    :return:
+def get_update_runs(updates):
     """
-    clients = {}
+    :param updates: update items, each with the 'index' of its row.
+    :return: lists of the updates of consecutive rows.
+    """
+    runs = []
+    for item in sorted(updates, key=lambda update: update['index']):
+        if runs and runs[-1][-1]['index'] == item['index'] - 1:
+            runs[-1].append(item)
+        else:
+            runs.append([item])
+    return runs
 
-    def get_service_client((account_num, cred_dict)):
-        clients[account_num] = boto3.client(
-            service_name,
-            region_name=region_name,
-            **cred_dict)
 
-    pool = ThreadPool()
-    logger.info(
-        'Creating {0} clients in region {1}...'.format(
-            service_name,
-            region_name))
-    pool.map(get_service_client, credentials.items())
+def get_deleted_ranges(indexes):
+    """
+    :param indexes: zero based indexes of rows to delete.
+    :return: (start, end) ranges of consecutive rows, from the bottom up so
+        deleting a range doesn't shift the ones after it.
+    """
+    ranges = []
+    for index in sorted(indexes, reverse=True):
+        if ranges and ranges[-1][0] == index + 1:
+            ranges[-1] = (index, ranges[-1][1])
+        else:
+            ranges.append((index, index + 1))
+    return ranges
 
-    return clients
 
+def execute_updates(contents, sheet):
+    """Executes the relevant updates, modify first and delete after, with a
+    single batchUpdate. Only the weight and region cells of the updated rows
+    are written, so the other cells keep their formulas and value types.
 
-def get_clients_all_regions(service_name, credentials):
-    """Returns a dict of service_name clients for each region, keys are the
-    region name. Each inner dict's keys are the account numbers.
+    :param contents: contents containing the changings.
+    :param sheet: Google Spreadsheet client.
+    """
+    updates = [item for item in contents[1:]
+               if 'weight' in item and 'region' in item and 'index' in item]
+    deletions = [i for i in range(1, len(contents))
+                 if 'delete' in contents[i]]
+    logger.info('Executing {0} value updates and {1} deletions...'.format(
+        len(updates), len(deletions)))
+    if not updates and not deletions:
+        return
+
+    requests = []
+    # Consecutive rows are written together, so when most rows change each
+    # column takes only a few requests
+    for run in get_update_runs(updates):
+        requests.append(get_cells_update_request(
+            sheet.id, run[0]['index'], COLUMNS['WEIGHT'],
+            [item['weight'] for item in run]))
+        requests.append(get_cells_update_request(
+            sheet.id, run[0]['index'], COLUMNS['REGION'],
+            [item['region'] for item in run]))
+    for start_index, end_index in get_deleted_ranges(deletions):
+        requests.append(get_delete_rows_request(sheet.id, start_index,
+                                                end_index))
+    sheet.spreadsheet.batch_update({'requests': requests})
+
+
+class ClientCache(object):
+    """Creates boto3 clients on first use and keeps them, keyed by service,
+    account number and region. Each account has a single boto3 session, so
+    the service models are loaded once per account rather than per client.
+    """
 
-    :param service_name: service name to use with boto3
-    :param credentials: credentials dict.
-    :return:
+    def __init__(self, credentials):
+        """
+        :param credentials: credentials dict, keys are account numbers.
+        """
+        self.credentials = credentials
+        self.sessions = {}
+        self.clients = {}
+        # Sessions aren't thread safe, so clients of an account are created
+        # one at a time
+        self.locks = dict((account_num, Lock()) for account_num in credentials)
+
+    def get(self, service_name, account_num, region_name='us-east-1'):
+        """
+        :param service_name: service name to use with boto3.
+        :param account_num: the account number.
+        :param region_name: the client's region.
+        :return: the cached client, created if needed.
+        """
+        key = (service_name, account_num, region_name)
+        client = self.clients.get(key)
+        if client is not None:
+            return client
+        with self.locks[account_num]:
+            if key not in self.clients:
+                session = self.sessions.get(account_num)
+                if session is None:
+                    session = boto3.session.Session(
+                        **self.credentials[account_num])
+                    self.sessions[account_num] = session
+                logger.info('Creating {0} client of account {1} in region '
+                            '{2}...'.format(service_name, account_num,
+                                            region_name))
+                self.clients[key] = session.client(service_name,
+                                                   region_name=region_name)
+            return self.clients[key]
+
+
+def get_worksheet():
+    """
+    :return: the Google Spreadsheet worksheet to validate.
     """
-    regional_clients = {}
-    for region in REGIONS:
-        regional_clients[region] = get_clients(
-            service_name,
-            credentials,
-            region)
-    return regional_clients
+    google_credentials = ServiceAccountCredentials.from_json_keyfile_name(
+        CREDENTIALS_FILE_PATH, scopes=SCOPES)
+    gc = gspread.authorize(google_credentials)
+    return gc.open_by_key(SPREADSHEET_ID).worksheet(WORKSHEET_NAME)
 
 
 def validate_data(credentials):
@@ -214,96 +653,110 @@ def validate_data(credentials):
 
     :param credentials: a dict of credentials, keys should be account numbers.
     """
-    google_credentials = ServiceAccountCredentials.from_json_keyfile_name(
-        CREDENTIALS_FILE_PATH, scopes=SCOPES)
-    gc = gspread.authorize(google_credentials)
-    sheet = gc.open_by_key(SPREADSHEET_ID).worksheet(WORKSHEET_NAME)
+    sheet = get_worksheet()
     contents = sheet.get_all_values()
-    s3_clients = get_clients('s3', credentials)
-    cloudwatch_clients = get_clients_all_regions('cloudwatch', credentials)
+    clients = ClientCache(credentials)
+    # Before anything is checked, so a failed listing deletes nothing
+    inventories = get_bucket_inventories(list(credentials), clients)
     bucket_names = set()
+    # Rows of the buckets that exist, which need their size
+    existing = []
 
     for i in range(len(contents)):
         contents[i] = [i, contents[i]]
 
-    def update_cell_status(item, lock):
-        """Updates the cell's status, whether to delete or modify.
-
-        :param item: item in the array of the spreadsheet contents.
-        :param lock: lock instance.
-        """
-        index = item[0]
-
-        def mark_cell_for_deletion():
+    logger.info('Calculating updates...')
+    # Main headers are also in contents, rows are checked in order so the
+    # first row of a duplicated bucket is the one kept
+    rows = contents[1:]
+    failed = 0
+    for index, curr_row in rows:
+        bucket_name = curr_row[COLUMNS['BUCKET_NAME']]
+        try:
+            exists = is_exist(bucket_name, inventories,
+                              curr_row[COLUMNS['ACCOUNT']])
+        except Exception:
+            logger.exception('Failed validating row {0}: {1}'.format(
+                index + 1, curr_row))
+            contents[index] = {}
+            failed += 1
+            continue
+        if bucket_name in bucket_names or not exists:
+            logger.info('Deleting row {0}: {1}'.format(index + 1, curr_row))
             contents[index] = {'delete': True}
-
-        def mark_cell_for_modification(weight, region):
+        else:
+            bucket_names.add(bucket_name)
+            existing.append((index, curr_row))
+    logger.info('Checked {0} rows, {1} failed'.format(len(rows), failed))
+
+    now = time.time()
+    snapshot = load_snapshot()
+    if snapshot is None:
+        checked = existing
+    else:
+        checked = select_rows(existing, snapshot, now)
+        for index, _ in existing:
+            contents[index] = {}
+        for entry_key, entry in snapshot.items():
+            account, bucket_name = entry_key.split('/', 1)
+            if entry['region']:
+                BUCKET_REGIONS.setdefault((bucket_name, account),
+                                          entry['region'])
+
+    regions = resolve_bucket_regions(
+        [(row[COLUMNS['BUCKET_NAME']], row[COLUMNS['ACCOUNT']])
+         for _, row in checked],
+        clients)
+    logger.info('Fetching the sizes of {0} buckets...'.format(len(checked)))
+    sizes = get_bucket_sizes(
+        [bucket + (region,) for bucket, region in regions.items()],
+        clients)
+    entries = {}
+    for index, curr_row in checked:
+        bucket = (curr_row[COLUMNS['BUCKET_NAME']],
+                  curr_row[COLUMNS['ACCOUNT']])
+        size = sizes.get(bucket, -1)
+        if size is None:
+            # Its request failed, leave it as is
+            contents[index] = {}
+            continue
+        if size == -1:
+            weight = -1
+            timestamp = None
+            actual_region = regions[bucket] or ''
+        else:
+            weight = round(size[0] / 1000000.0, 2)
+            timestamp = size[1]
+            actual_region = size[2]
+        entries[get_snapshot_key(*bucket)] = {
+            'region': actual_region,
+            'size': None if size == -1 else size[0],
+            'timestamp': timestamp,
+            'checked_at': now,
+            'row_hash': get_row_hash(curr_row)
+        }
+        if str(weight) != curr_row[COLUMNS['WEIGHT']] \
+                or actual_region != curr_row[COLUMNS['REGION']]:
             contents[index] = {
                 'weight': weight,
-                'region': region,
+                'region': actual_region,
                 'index': index}
-
-        def mark_cell_neutral():
-            contents[index] = {}
-
-        curr_row = item[1]
-        account = curr_row[COLUMNS['ACCOUNT']]
-        bucket_name = curr_row[COLUMNS['BUCKET_NAME']]
-        lock.acquire()
-        duplicate = bucket_name in bucket_names
-        if not duplicate:
-            bucket_names.add(bucket_name)
-        lock.release()
-
-        if duplicate or not is_exist(
-                bucket_name,
-                s3_clients[account],
-                account):
-            mark_cell_for_deletion()
         else:
-            actual_region = curr_row[COLUMNS['REGION']]
-            if not actual_region:
-                actual_region = REGIONS[0]
-            weight = get_bucket_size(
-                bucket_name,
-                cloudwatch_clients[actual_region][account],
-                lambda x: round(x / 1000000.0, 2))
-            if weight == -1:
-                for region in REGIONS:
-                    if region != actual_region:
-                        weight = get_bucket_size(
-                            bucket_name,
-                            cloudwatch_clients[region][account],
-                            lambda x: round(x / 1000000.0, 2))
-                        if weight != -1:
-                            actual_region = region
-                            break
-                else:
-                    actual_region = ''
-            if str(weight) != curr_row[COLUMNS['WEIGHT']] \
-                    or actual_region != curr_row[COLUMNS['REGION']]:
-                mark_cell_for_modification(weight, actual_region)
-            else:
-                mark_cell_neutral()
-
-    logger.info('Calculating updates...')
-    # Main headers are also in contents
-    lock = Lock()
-    processes = []
-    i = 1
-    while i < len(contents[1:]):
-        p = Process(target=update_cell_status, args=(contents[i], lock))
-        processes.append(p)
-        p.start()
-        if len(processes) >= 10:
-            for j in range(len(processes)):
-                processes.pop().join()
-        i += 1
-    # End the remaining processes
-    for p in processes:
-        p.join()
+            contents[index] = {}
     execute_updates(contents, sheet)
 
+    if snapshot is not None:
+        # Only the rows that are still in the sheet, the skipped ones keep
+        # their previous entry
+        new_snapshot = {}
+        for _, curr_row in existing:
+            entry_key = get_snapshot_key(curr_row[COLUMNS['BUCKET_NAME']],
+                                         curr_row[COLUMNS['ACCOUNT']])
+            entry = entries.get(entry_key, snapshot.get(entry_key))
+            if entry is not None:
+                new_snapshot[entry_key] = entry
+        save_snapshot(new_snapshot)
+
 
 def main(event, context):
     credentials = get_credentials_dict(sts_client)
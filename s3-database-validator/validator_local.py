@@ -0,0 +1,224 @@
+"""In-process stand-ins for the Google Sheets, S3 and CloudWatch backends of
+s3_database_validator, with configurable latency and throttling, for
+measuring it without touching real accounts or the real spreadsheet.
+"""
+import random
+import threading
+import time
+from datetime import datetime
+
+from botocore.exceptions import ClientError
+
+
+class CallCounter(object):
+    """Counts the API calls made to the fake backends, by type.
+    """
+
+    def __init__(self):
+        self.counts = {}
+        self._lock = threading.Lock()
+
+    def add(self, name):
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+
+class FakeService(object):
+    """Simulates the latency of every call, and throttling errors that are
+    retried with exponential backoff the way botocore retries them.
+    """
+
+    def __init__(self, counter, latency=0.0, throttle_rate=0.0,
+                 max_attempts=5, seed=None):
+        """
+        :param counter: a CallCounter.
+        :param latency: seconds each call takes.
+        :param throttle_rate: the probability of a call being throttled.
+        :param max_attempts: attempts before a throttled call fails.
+        :param seed: a seed for the throttling.
+        """
+        self.counter = counter
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.max_attempts = max_attempts
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _call(self, operation_name):
+        for attempt in range(self.max_attempts):
+            self.counter.add(operation_name)
+            if self.latency:
+                time.sleep(self.latency)
+            with self._lock:
+                throttled = self._random.random() < self.throttle_rate
+            if not throttled:
+                return
+            self.counter.add(operation_name + ':throttled')
+            time.sleep(min(0.05 * 2 ** attempt, 1.0))
+        raise ClientError({'Error': {'Code': 'Throttling',
+                                     'Message': 'Rate exceeded'}},
+                          operation_name)
+
+
+class FakeWorld(object):
+    """The buckets of all the accounts, as a dict of account number ->
+    bucket name -> (region, size in bytes).
+    """
+
+    def __init__(self, buckets, counter, aws_latency=0.0, throttle_rate=0.0,
+                 seed=None):
+        self.buckets = buckets
+        self.counter = counter
+        self.aws_latency = aws_latency
+        self.throttle_rate = throttle_rate
+        self.seed = seed
+
+
+class FakeS3Client(FakeService):
+    """Implements the parts of the boto3 S3 client used by the validator.
+    """
+
+    def __init__(self, world, account_num):
+        super(FakeS3Client, self).__init__(
+            world.counter, world.aws_latency, world.throttle_rate, seed=(
+                world.seed, 's3', account_num))
+        self.buckets = world.buckets.get(account_num, {})
+
+    def list_buckets(self, **kwargs):
+        self._call('s3.list_buckets')
+        return {'Buckets': [{'Name': name} for name in sorted(self.buckets)]}
+
+    def get_bucket_location(self, Bucket):
+        self._call('s3.get_bucket_location')
+        if Bucket not in self.buckets:
+            raise ClientError({'Error': {'Code': 'NoSuchBucket'}},
+                              'GetBucketLocation')
+        region = self.buckets[Bucket][0]
+        return {'LocationConstraint':
+                None if region == 'us-east-1' else region}
+
+
+class FakeCloudWatchClient(FakeService):
+    """Implements GetMetricData over the sizes of the buckets in its region,
+    reported as StandardStorage.
+    """
+
+    def __init__(self, world, account_num, region_name):
+        super(FakeCloudWatchClient, self).__init__(
+            world.counter, world.aws_latency, world.throttle_rate, seed=(
+                world.seed, 'cloudwatch', account_num, region_name))
+        self.buckets = world.buckets.get(account_num, {})
+        self.region_name = region_name
+
+    def get_metric_data(self, MetricDataQueries, **kwargs):
+        self._call('cloudwatch.get_metric_data')
+        if len(MetricDataQueries) > 500:
+            raise ClientError({'Error': {'Code': 'ValidationError'}},
+                              'GetMetricData')
+        today = datetime.utcnow().replace(hour=0, minute=0, second=0,
+                                          microsecond=0)
+        results = []
+        for query in MetricDataQueries:
+            dimensions = dict(
+                (dimension['Name'], dimension['Value']) for dimension
+                in query['MetricStat']['Metric']['Dimensions'])
+            bucket = self.buckets.get(dimensions['BucketName'])
+            if bucket and bucket[0] == self.region_name \
+                    and dimensions['StorageType'] == 'StandardStorage':
+                results.append({'Id': query['Id'], 'Timestamps': [today],
+                                'Values': [float(bucket[1])],
+                                'StatusCode': 'Complete'})
+            else:
+                results.append({'Id': query['Id'], 'Timestamps': [],
+                                'Values': [], 'StatusCode': 'Complete'})
+        return {'MetricDataResults': results}
+
+
+class FakeClientCache(object):
+    """Stands in for s3_database_validator.ClientCache.
+    """
+
+    def __init__(self, world):
+        self.world = world
+        self.clients = {}
+        self._lock = threading.Lock()
+
+    def get(self, service_name, account_num, region_name='us-east-1'):
+        key = (service_name, account_num, region_name)
+        with self._lock:
+            if key not in self.clients:
+                if service_name == 's3':
+                    client = FakeS3Client(self.world, account_num)
+                else:
+                    client = FakeCloudWatchClient(self.world, account_num,
+                                                  region_name)
+                self.clients[key] = client
+            return self.clients[key]
+
+
+def parse_user_entered(value):
+    """Parses a value the way Sheets parses a USER_ENTERED string, only as
+    far as numbers go.
+
+    :param value: the entered value.
+    :return: the stored value.
+    """
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return value
+
+
+class FakeWorksheet(object):
+    """A worksheet that applies the gspread calls the validator makes to an
+    in-memory list of rows. The cells keep the types they were entered with,
+    and are read back formatted as strings, the way gspread reads them.
+    """
+
+    def __init__(self, rows, counter, latency=0.0, title='buckets'):
+        """
+        :param rows: the worksheet's rows, including the headers.
+        :param counter: a CallCounter.
+        :param latency: seconds each call takes.
+        :param title: the worksheet's title.
+        """
+        self.rows = rows
+        self.counter = counter
+        self.latency = latency
+        self.id = 0
+        self.title = title
+        self.spreadsheet = self
+
+    def _call(self, operation_name):
+        self.counter.add(operation_name)
+        if self.latency:
+            time.sleep(self.latency)
+
+    def get_all_values(self):
+        self._call('sheets.get_all_values')
+        return [[str(value) for value in row] for row in self.rows]
+
+    def values_update(self, range, params=None, body=None):
+        self._call('sheets.values_update')
+        user_entered = (params or {}).get('valueInputOption') == \
+            'USER_ENTERED'
+        for i, row in enumerate(body['values']):
+            self.rows[i] = [parse_user_entered(value) if user_entered
+                            else value for value in row]
+        return {}
+
+    def batch_update(self, body):
+        self._call('sheets.batch_update')
+        for request in body['requests']:
+            if 'updateCells' in request:
+                start = request['updateCells']['start']
+                for i, row in enumerate(request['updateCells']['rows']):
+                    for j, cell in enumerate(row['values']):
+                        value = list(cell['userEnteredValue'].values())[0]
+                        self.rows[start['rowIndex'] + i][
+                            start['columnIndex'] + j] = value
+            else:
+                dimension_range = request['deleteDimension']['range']
+                del self.rows[dimension_range['startIndex']:
+                              dimension_range['endIndex']]
+        return {}